@@ -0,0 +1,265 @@
+#!/usr/bin/python
+"""
+benchmarks.pipeline
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+# End to end benchmark of the request pipeline.  Builds a SQLite database
+# with the core schema in a temporary directory, seeds it, then sends
+# requests straight to the WSGI application and measures throughput and
+# latency for each kind of page and each output format.
+#
+# Usage: python pipeline.py [--users N] [--classes N] [--logs N]
+#                           [--requests N] [--output results.json]
+#
+# Results are written as JSON so runs can be compared between releases.
+
+import argparse, base64, datetime, json, os, platform, shutil, subprocess
+import sys, tempfile, time
+from StringIO import StringIO
+
+LESSON_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'src', 'lesson'))
+sys.path.insert(0, LESSON_DIR)
+
+import ConfigParser
+
+import sqlalchemy
+from sqlalchemy import create_engine
+
+ADMIN = u'admin'
+PASSWORD = 'benchmark'
+CHUNK = 10000
+
+def write_config(workdir):
+    """
+    Write lesson.conf for a SQLite database in workdir
+    """
+    from controller import config
+
+    path = os.path.join(workdir, 'config', 'lesson.conf')
+    config.create_file_config(path)
+    file_config = ConfigParser.RawConfigParser()
+    file_config.read(path)
+    file_config.set('Main', 'database', u'sqlite:///%s' % (os.path.join(workdir, 'lesson.db'),))
+    file_config.set('Main', 'script dir', os.path.join(os.path.dirname(LESSON_DIR), '..', 'scripts'))
+    file_config.set('Auth', 'token secret', u'benchmark')
+    file_config.set('Timing', 'slow request threshold', u'0')
+    file_config.set('Metrics', 'directory', os.path.join(workdir, 'metrics'))
+    file_config.set('Logging', 'level', u'error')
+    with open(path, 'wb') as f:
+        file_config.write(f)
+    return file_config.get('Main', 'database')
+
+def _insert(connection, table, rows):
+    for start in range(0, len(rows), CHUNK):
+        connection.execute(table.insert(), rows[start:start + CHUNK])
+
+def seed(database, users, classes, logs):
+    """
+    Create the core schema and fill it with users, classes, class lists and
+    log entries.  Returns the names of a sample user and class teacher.
+    """
+    from model import core
+    from controller import password
+
+    engine = create_engine(database)
+    core.Base.metadata.create_all(engine)
+
+    # Hashing is slow on purpose, so every user shares one hash
+    pwhash = password.encrypt(PASSWORD)
+    today = datetime.date(2000, 1, 1)
+
+    with engine.begin() as connection:
+        _insert(connection, core.Version.__table__, [{'UUID': core.uuid, 'Type': u'core', 'VersionNumber': core.version}])
+        _insert(connection, core.Department.__table__, [
+            {'DepartmentIndex': index, 'Department': u'Department %i' % (index,)} for index in range(1, 4)])
+        _insert(connection, core.Year.__table__, [{'YearIndex': 1, 'Year': u'2015', 'YearNumber': 1}])
+        _insert(connection, core.Term.__table__, [{'TermIndex': 1, 'TermNumber': 1, 'TermName': u'Term 1',
+                                                   'DepartmentIndex': 1}])
+
+        rows = [{'Username': ADMIN, 'FirstName': u'Admin', 'Surname': u'User', 'Password': pwhash,
+                 'Permissions': 1, 'DepartmentIndex': 1}]
+        for index in range(1, users):
+            rows.append({'Username': u'user%05i' % (index,), 'FirstName': u'First %i' % (index,),
+                         'Surname': u'Surname %i' % (index,), 'Password': pwhash, 'Permissions': 0,
+                         'DOB': today - datetime.timedelta(days=index % 5000),
+                         'DepartmentIndex': index % 3 + 1, 'ActiveStudent': 1})
+        _insert(connection, core.User.__table__, rows)
+        usernames = [row['Username'] for row in rows]
+
+        # Each teacher has about four classes, so filtering classes by
+        # teacher returns more than one row
+        teachers = usernames[1:max(2, classes // 4 + 1)] or usernames
+        _insert(connection, core.Class.__table__, [
+            {'ClassIndex': index, 'ClassName': u'Class %i' % (index,), 'YearIndex': 1,
+             'ClassTeacherUsername': teachers[index % len(teachers)], 'DepartmentIndex': index % 3 + 1}
+            for index in range(1, classes + 1)])
+        _insert(connection, core.ClassTerm.__table__, [
+            {'ClassTermIndex': index, 'ClassIndex': index, 'TermIndex': 1} for index in range(1, classes + 1)])
+        _insert(connection, core.ClassList.__table__, [
+            {'ClassTermIndex': index % classes + 1, 'Username': username,
+             'HODUsername': ADMIN, 'PrincipalUsername': ADMIN}
+            for (index, username) in enumerate(usernames[1:])])
+
+        start = datetime.datetime(2015, 1, 1)
+        for first in range(0, logs, CHUNK):
+            connection.execute(core.Log.__table__.insert(), [
+                {'Username': usernames[index % len(usernames)], 'Level': 3,
+                 'Time': start + datetime.timedelta(seconds=index), 'Comment': u'Accessed page',
+                 'Page': u'users', 'RemoteHost': u'127.0.0.1'}
+                for index in range(first, min(first + CHUNK, logs))])
+
+    engine.dispose()
+    return (usernames[len(usernames) // 2], teachers[min(5, classes) % len(teachers)])
+
+class Client(object):
+    """
+    Sends requests straight to a WSGI application
+    """
+
+    def __init__(self, application, username, passwd):
+        self.application = application
+        self.authorization = 'Basic ' + base64.b64encode('%s:%s' % (username, passwd))
+
+    def get(self, url):
+        (path, _sep, query) = url.partition('?')
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query,
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'HTTP_HOST': 'localhost',
+                   'REMOTE_ADDR': '127.0.0.1', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'HTTP_AUTHORIZATION': self.authorization,
+                   'wsgi.url_scheme': 'http', 'wsgi.input': StringIO(''), 'wsgi.errors': sys.stderr}
+        response = {}
+
+        def start_response(status, headers, exc_info=None):  # @UnusedVariable
+            response['status'] = status
+
+        size = 0
+        for chunk in self.application(environ, start_response):
+            size += len(chunk)
+        return (response['status'], size)
+
+def _percentile(ordered, percent):
+    return ordered[int(round(percent / 100.0 * (len(ordered) - 1)))]
+
+def run(client, url, requests, warmup):
+    """
+    Request url requests times after warmup unmeasured requests, and return
+    dictionary of results
+    """
+    for _count in range(warmup):
+        client.get(url)
+
+    latencies = []
+    statuses = {}
+    size = 0
+    start = time.time()
+    for _count in range(requests):
+        request_start = time.time()
+        (status, size) = client.get(url)
+        latencies.append(time.time() - request_start)
+        statuses[status] = statuses.get(status, 0) + 1
+    elapsed = time.time() - start
+
+    latencies.sort()
+    return {'url': url,
+            'requests': requests,
+            'throughput': requests / elapsed,
+            'mean_ms': sum(latencies) / len(latencies) * 1000,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+            'response_bytes': size,
+            'statuses': statuses}
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=LESSON_DIR,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LESSON request pipeline against SQLite')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--classes', type=int, default=200)
+    parser.add_argument('--logs', type=int, default=500000)
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per page')
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per page')
+    parser.add_argument('--output', help='file to write results to instead of stdout')
+    parser.add_argument('--keep', action='store_true', help="don't delete the temporary database")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='lesson-benchmark-')
+    try:
+        database = write_config(workdir)
+        seed_start = time.time()
+        (username, teacher) = seed(database, args.users, args.classes, args.logs)
+        seed_time = time.time() - seed_start
+
+        # The backend reads config/lesson.conf from the working directory
+        os.chdir(workdir)
+        startup_start = time.time()
+        import render
+        application = render.start('wsgi')
+        startup_time = time.time() - startup_start
+
+        client = Client(application, ADMIN, PASSWORD)
+        pages = [
+            ('list', '/users?format=json'),
+            ('list_keyset', '/logs?format=json&limit=100'),
+            ('object', '/users/%s?format=json' % (username,)),
+            ('attributes', '/users/%s/attributes?format=json' % (username,)),
+            # Class lists have no pages of their own, so there's no
+            # /classes/N/users, and classes are filtered by teacher instead
+            ('filtered', '/users/%s/classes?format=json' % (teacher,)),
+            ('filtered_list', '/departments/1/users?format=json'),
+        ]
+        for output_format in ('json', 'xml', 'csv', 'txt', 'html'):
+            pages.append(('format_%s' % (output_format,), '/users?format=%s&limit=500' % (output_format,)))
+
+        results = {}
+        for (name, url) in pages:
+            results[name] = run(client, url, args.requests, args.warmup)
+            if results[name]['statuses'].keys() != ['200 OK']:
+                sys.stderr.write('Warning: %s returned %s\n' % (url, ', '.join(sorted(results[name]['statuses']))))
+
+        if render._global_data.log.writer is not None:
+            render._global_data.log.writer.close()
+        report = {'meta': {'time': datetime.datetime.utcnow().isoformat(),
+                           'revision': _revision(),
+                           'python': platform.python_version(),
+                           'sqlalchemy': sqlalchemy.__version__,
+                           'users': args.users, 'classes': args.classes, 'logs': args.logs,
+                           'requests': args.requests, 'warmup': args.warmup,
+                           'seed_seconds': seed_time, 'startup_seconds': startup_time,
+                           'startup_phases': [[phase, seconds] for (phase, seconds) in render.startup_times]},
+                  'results': results}
+    finally:
+        if args.keep:
+            sys.stderr.write('Database kept in %s\n' % (workdir,))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
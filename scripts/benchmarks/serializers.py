@@ -0,0 +1,248 @@
+#!/usr/bin/python
+"""
+benchmarks.serializers
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+# Microbenchmarks for the serializers in render_commands.  Each serializer
+# is run against the payloads that pages produce: {u'list': [...]} from
+# ListPage (also as a streamed list), {u'attributes': [...]} from AttrPage
+# and nested dictionaries from views, at several sizes.
+#
+# Usage: python serializers.py [--sizes 10,1000] [--time 0.5]
+#                              [--only json,csv] [--output results.json]
+#
+# For every serializer and payload, this reports operations per second, the
+# size of the output and the memory allocated while rendering.  Python 2
+# has no tracemalloc, so memory is measured as the growth in the peak
+# resident set size of a forked child process that renders the payload
+# once.  This includes freed memory that the allocator keeps hold of, so
+# it's only useful for comparing cases with each other.
+
+import argparse, datetime, gc, json, os, sys, time
+
+LESSON_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'src', 'lesson'))
+sys.path.insert(0, LESSON_DIR)
+
+from render_commands import RenderCom, StreamList, tablize
+
+START = datetime.datetime(2015, 1, 1, 8, 0, 0)
+DOB = datetime.date(2000, 1, 1)
+
+def list_payload(size):
+    """
+    Rows as produced by ListPage
+    """
+    return {u'list': [{u'Username': u'user%05i' % (index,),
+                       u'link': u'http://localhost/users/user%05i' % (index,)}
+                      for index in range(size)],
+            u'next': u'http://localhost/users?after=abc&limit=%i' % (size,)}
+
+def stream_payload(size):
+    """
+    Rows as produced by ListPage for large pages, sent while they're read
+    """
+    payload = list_payload(size)
+    payload[u'list'] = StreamList(payload[u'list'])
+    return payload
+
+def attributes_payload(size):
+    """
+    Attributes as produced by AttrPage, with dates and missing values.  size
+    is the number of attributes.
+    """
+    attributes = []
+    for index in range(size):
+        kind = index % 5
+        if kind == 0:
+            value = u'Value %i' % (index,)
+        elif kind == 1:
+            value = index
+        elif kind == 2:
+            value = DOB + datetime.timedelta(days=index)
+        elif kind == 3:
+            value = START + datetime.timedelta(minutes=index)
+        else:
+            value = None
+        attributes.append({u'name': u'Attribute%i' % (index,), u'value': value})
+    return {u'attributes': attributes}
+
+def view_payload(size):
+    """
+    Nested dictionaries as produced by views, with size classes
+    """
+    return {u'user': u'user00001', u'firstname': u'First', u'surname': u'Surname',
+            u'details': {u'dob': DOB, u'left': None, u'joined': START, u'department': 1},
+            u'classes': [{u'name': u'Class %i' % (index,),
+                          u'link': u'http://localhost/classes/%i' % (index,),
+                          u'teacher': {u'username': u'user%05i' % (index,), u'since': DOB},
+                          u'room': None}
+                         for index in range(size)]}
+
+PAYLOADS = [('list', list_payload), ('list_stream', stream_payload),
+            ('attributes', attributes_payload), ('view', view_payload)]
+
+def _tablize_csv(rendercom, **args):  # @UnusedVariable
+    # As in RenderCom, the next page link is left out of tables
+    args.pop(u'next', None)
+    return tablize(args, u"", u"", ("", "\n"), ("", ",", ""), ("", ",", ""), True)
+
+SERIALIZERS = [('json', lambda rendercom, **args: rendercom.render_json(**args)),
+               ('xml', lambda rendercom, **args: rendercom.render_xml(**args)),
+               ('csv', lambda rendercom, **args: rendercom.render_csv(**args)),
+               ('txt', lambda rendercom, **args: rendercom.render_txt(**args)),
+               ('html', lambda rendercom, **args: rendercom.render_html(**args)),
+               ('tablize', _tablize_csv)]
+
+def render(serializer, rendercom, payload):
+    """
+    Render payload and return its size in bytes, reading it in full if it's
+    sent in pieces
+    """
+    output = serializer(rendercom, **payload)
+    if isinstance(output, basestring):
+        output = [output]
+    size = 0
+    for chunk in output:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        size += len(chunk)
+    return size
+
+def _status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+def allocated(serializer, factory, size):
+    """
+    Return bytes allocated rendering a payload once, measured in a forked
+    child, or None if this can't be measured here
+    """
+    if not hasattr(os, 'fork') or not os.path.exists('/proc/self/status'):
+        return None
+
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        result = 'None'
+        try:
+            os.close(read_fd)
+            rendercom = RenderCom()
+            payload = factory(size)
+            gc.collect()
+            # Writing 5 to clear_refs resets the peak to the current size
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            before = _status_kb('VmHWM')
+            render(serializer, rendercom, payload)
+            result = str((_status_kb('VmHWM') - before) * 1024)
+        except (IOError, OSError, KeyError):
+            pass
+        finally:
+            os.write(write_fd, result)
+            os._exit(0)
+
+    os.close(write_fd)
+    result = ''
+    while True:
+        data = os.read(read_fd, 64)
+        if not data:
+            break
+        result += data
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    if result in ('', 'None'):
+        return None
+    return int(result)
+
+def run(serializer, factory, size, min_time):
+    """
+    Render payloads from factory until min_time seconds have passed and
+    return dictionary of results.  Payloads are built outside the timed
+    part, except for streamed lists, which can only be read once.
+    """
+    rendercom = RenderCom()
+    payload = factory(size)
+    stream = any(isinstance(value, StreamList) for value in payload.values())
+    output_bytes = render(serializer, rendercom, payload)
+
+    operations = 0
+    elapsed = 0.0
+    while elapsed < min_time:
+        if stream or operations == 0:
+            payload = factory(size)
+        start = time.time()
+        render(serializer, rendercom, payload)
+        elapsed += time.time() - start
+        operations += 1
+
+    return {'ops_per_sec': operations / elapsed,
+            'us_per_op': elapsed / operations * 1000000,
+            'output_bytes': output_bytes,
+            'allocated_bytes': allocated(serializer, factory, size)}
+
+def _format_bytes(value):
+    if value is None:
+        return '-'
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(value) < 1024:
+            return '%.0f%s' % (value, unit)
+        value /= 1024.0
+    return '%.1fGiB' % (value,)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the LESSON output serializers')
+    parser.add_argument('--sizes', default='10,1000', help='comma separated payload sizes (rows)')
+    parser.add_argument('--time', type=float, default=0.5, help='minimum seconds to run each case for')
+    parser.add_argument('--only', help='comma separated serializers to run')
+    parser.add_argument('--payloads', help='comma separated payloads to run')
+    parser.add_argument('--output', help='file to write results to as JSON')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    serializers = SERIALIZERS
+    if args.only:
+        serializers = [s for s in SERIALIZERS if s[0] in args.only.split(',')]
+    payloads = PAYLOADS
+    if args.payloads:
+        payloads = [p for p in PAYLOADS if p[0] in args.payloads.split(',')]
+
+    results = []
+    print '%-8s %-12s %7s %12s %12s %10s %10s' % ('format', 'payload', 'size', 'ops/sec', 'us/op',
+                                                 'output', 'allocated')
+    for (serializer_name, serializer) in serializers:
+        for (payload_name, factory) in payloads:
+            for size in sizes:
+                result = run(serializer, factory, size, args.time)
+                print '%-8s %-12s %7i %12.1f %12.1f %10s %10s' % (
+                    serializer_name, payload_name, size, result['ops_per_sec'], result['us_per_op'],
+                    _format_bytes(result['output_bytes']), _format_bytes(result['allocated_bytes']))
+                sys.stdout.flush()
+                result.update({'serializer': serializer_name, 'payload': payload_name, 'size': size})
+                results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': datetime.datetime.utcnow().isoformat(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+"""
+build_manifest
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+# Rebuild the route manifest (see manifest.py).  The backend rebuilds it by
+# itself when view files change, so this is only needed to write it ahead
+# of time, such as when the backend can't write to the view directory.
+# This starts the backend once without the manifest, which imports every
+# view and writes a new one.  It needs the same configuration file and
+# database as the backend.
+
+import os, sys
+
+# Run from the backend's directory, as main.py does, so the same
+# configuration file is used
+lesson_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'lesson'))
+sys.path.insert(0, lesson_dir)
+os.chdir(lesson_dir)
+
+from controller import config
+
+path = config.get_file_option(config.get_file_config(), 'Main', 'route manifest', u'view/manifest.json')
+if not path:
+    sys.stderr.write("The route manifest is disabled in the configuration file\n")
+    sys.exit(1)
+path = os.path.join(lesson_dir, path)
+if os.path.exists(path):
+    os.unlink(path)
+
+import render  # @UnusedImport
+
+if not os.path.exists(path):
+    sys.stderr.write("Unable to write route manifest '%s'\n" % (path,))
+    sys.exit(1)
+print "Wrote route manifest '%s'" % (path,)
@@ -0,0 +1,300 @@
+#!/usr/bin/python
+"""
+memcached_stub
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+# A small memcached compatible server for testing the memcached cache
+# backend (see controller/cache.py) on a machine without memcached.  It
+# speaks enough of the text protocol for the backend: get, gets, set, add,
+# replace, append, prepend, delete, incr, decr, touch, flush_all, stats,
+# version and quit.  Values are kept in memory and evicted least recently
+# used first once they take up more than the memory limit.
+#
+# Usage: python memcached_stub.py [--host 127.0.0.1] [--port 11211]
+#                                 [--memory 64]
+#
+# This isn't meant for production use.
+
+import argparse, os, SocketServer, sys, threading, time
+from collections import OrderedDict
+
+# Largest value that will be stored, as in memcached
+MAX_ITEM_SIZE = 1024 * 1024
+# Relative expiry times longer than this are absolute times
+RELATIVE_EXPIRY_LIMIT = 60 * 60 * 24 * 30
+
+class Store(object):
+    """
+    Values with flags and expiry times, limited to size bytes
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.cas = 0
+        self.started = time.time()
+        self.counts = dict((name, 0) for name in ('cmd_get', 'cmd_set', 'get_hits', 'get_misses',
+                                                  'evictions', 'total_items'))
+        # key -> (flags, expiry, data, cas)
+        self._items = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def expiry(exptime):
+        if exptime == 0:
+            return 0
+        if exptime < 0:
+            return -1
+        if exptime > RELATIVE_EXPIRY_LIMIT:
+            return exptime
+        return time.time() + exptime
+
+    def get(self, key):
+        """
+        Must be called with self.lock held
+        """
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[1] and item[1] <= time.time():
+            self.delete(key)
+            return None
+        self._items[key] = self._items.pop(key)
+        return item
+
+    def put(self, key, flags, expiry, data):
+        """
+        Must be called with self.lock held
+        """
+        self.delete(key)
+        if expiry == -1:
+            return
+        self.cas += 1
+        self._items[key] = (flags, expiry, data, self.cas)
+        self.used += len(key) + len(data)
+        self.counts['total_items'] += 1
+        while self.used > self.size:
+            self.delete(next(iter(self._items)))
+            self.counts['evictions'] += 1
+
+    def delete(self, key):
+        """
+        Must be called with self.lock held
+        """
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.used -= len(key) + len(item[2])
+        return item is not None
+
+    def flush(self):
+        self._items.clear()
+        self.used = 0
+
+    def stats(self):
+        stats = [('pid', os.getpid()),
+                 ('uptime', int(time.time() - self.started)),
+                 ('time', int(time.time())),
+                 ('version', 'lesson-stub'),
+                 ('curr_items', len(self._items)),
+                 ('bytes', self.used),
+                 ('limit_maxbytes', self.size)]
+        stats.extend(sorted(self.counts.items()))
+        return stats
+
+class Handler(SocketServer.StreamRequestHandler):
+    """
+    Handles one client connection
+    """
+
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if not line.endswith('\r\n'):
+                self.send('CLIENT_ERROR line not terminated')
+                return
+            parts = line[:-2].split()
+            if not parts:
+                self.send('ERROR')
+                continue
+            command = parts[0]
+            method = getattr(self, 'do_' + command, None)
+            if method is None:
+                self.send('ERROR')
+                continue
+            try:
+                if method(store, parts[1:]) is False:
+                    return
+            except (ValueError, IndexError):
+                self.send('CLIENT_ERROR bad command line format')
+            self.wfile.flush()
+
+    def _noreply(self, args, count):
+        return len(args) > count and args[count] == 'noreply'
+
+    def do_get(self, store, args, with_cas=False):
+        output = []
+        with store.lock:
+            for key in args:
+                store.counts['cmd_get'] += 1
+                item = store.get(key)
+                if item is None:
+                    store.counts['get_misses'] += 1
+                    continue
+                store.counts['get_hits'] += 1
+                if with_cas:
+                    output.append('VALUE %s %i %i %i\r\n%s\r\n' % (key, item[0], len(item[2]), item[3], item[2]))
+                else:
+                    output.append('VALUE %s %i %i\r\n%s\r\n' % (key, item[0], len(item[2]), item[2]))
+        output.append('END\r\n')
+        self.wfile.write(''.join(output))
+
+    def do_gets(self, store, args):
+        self.do_get(store, args, True)
+
+    def _storage(self, store, args, command):
+        (key, flags, exptime, length) = (args[0], int(args[1]), int(args[2]), int(args[3]))
+        noreply = self._noreply(args, 4)
+        data = self.rfile.read(length + 2)
+        if len(data) != length + 2 or not data.endswith('\r\n'):
+            self.send('CLIENT_ERROR bad data chunk')
+            return False
+        data = data[:-2]
+        if length > MAX_ITEM_SIZE:
+            if not noreply:
+                self.send('SERVER_ERROR object too large for cache')
+            return
+
+        with store.lock:
+            store.counts['cmd_set'] += 1
+            item = store.get(key)
+            if command == 'add' and item is not None:
+                result = 'NOT_STORED'
+            elif command in ('replace', 'append', 'prepend') and item is None:
+                result = 'NOT_STORED'
+            else:
+                if command == 'append':
+                    (flags, data) = (item[0], item[2] + data)
+                elif command == 'prepend':
+                    (flags, data) = (item[0], data + item[2])
+                if command in ('append', 'prepend'):
+                    expiry = item[1]
+                else:
+                    expiry = store.expiry(exptime)
+                store.put(key, flags, expiry, data)
+                result = 'STORED'
+        if not noreply:
+            self.send(result)
+
+    def do_set(self, store, args):
+        return self._storage(store, args, 'set')
+
+    def do_add(self, store, args):
+        return self._storage(store, args, 'add')
+
+    def do_replace(self, store, args):
+        return self._storage(store, args, 'replace')
+
+    def do_append(self, store, args):
+        return self._storage(store, args, 'append')
+
+    def do_prepend(self, store, args):
+        return self._storage(store, args, 'prepend')
+
+    def do_delete(self, store, args):
+        with store.lock:
+            deleted = store.delete(args[0])
+        if not self._noreply(args, 1):
+            self.send('DELETED' if deleted else 'NOT_FOUND')
+
+    def _arithmetic(self, store, args, sign):
+        (key, delta) = (args[0], int(args[1]))
+        with store.lock:
+            item = store.get(key)
+            if item is None:
+                result = 'NOT_FOUND'
+            elif not item[2].isdigit():
+                result = 'CLIENT_ERROR cannot increment or decrement non-numeric value'
+            else:
+                # Counters are unsigned 64 bit values that don't go below 0
+                value = max(0, int(item[2]) + sign * delta) % (2 ** 64)
+                store.put(key, item[0], item[1], str(value))
+                result = str(value)
+        if not self._noreply(args, 2):
+            self.send(result)
+
+    def do_incr(self, store, args):
+        self._arithmetic(store, args, 1)
+
+    def do_decr(self, store, args):
+        self._arithmetic(store, args, -1)
+
+    def do_touch(self, store, args):
+        with store.lock:
+            item = store.get(args[0])
+            if item is not None:
+                store.put(args[0], item[0], store.expiry(int(args[1])), item[2])
+        if not self._noreply(args, 2):
+            self.send('TOUCHED' if item is not None else 'NOT_FOUND')
+
+    def do_flush_all(self, store, args):
+        with store.lock:
+            store.flush()
+        if not (args and args[-1] == 'noreply'):
+            self.send('OK')
+
+    def do_stats(self, store, args):  # @UnusedVariable
+        with store.lock:
+            stats = store.stats()
+        self.wfile.write(''.join('STAT %s %s\r\n' % (name, value) for (name, value) in stats) + 'END\r\n')
+
+    def do_version(self, store, args):  # @UnusedVariable
+        self.send('VERSION lesson-stub')
+
+    def do_quit(self, store, args):  # @UnusedVariable
+        return False
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, size):
+        SocketServer.TCPServer.__init__(self, address, Handler)
+        self.store = Store(size)
+
+def main():
+    parser = argparse.ArgumentParser(description='Minimal memcached compatible server for testing')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11211)
+    parser.add_argument('--memory', type=int, default=64, help='memory limit in megabytes')
+    args = parser.parse_args()
+
+    server = Server((args.host, args.port), args.memory * 1024 * 1024)
+    sys.stderr.write('Listening on %s:%i\n' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+"""
+upgrade
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+# Check the database against the versions of the backend's modules and run
+# any update files needed to bring it up to date.  The backend itself never
+# runs update files, and shows an error page until this has been run.
+#
+# Usage: python upgrade.py [--check]
+#
+# With --check, the database is only checked.  The exit status is 0 if it's
+# up to date and 1 if it isn't.  Once the database is up to date, the
+# version stamp is written, so backend processes don't need to check the
+# database when they start.
+
+import argparse, os, sys
+
+# Run from the backend's directory, as main.py does, so the same
+# configuration file and script directory are used
+lesson_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src', 'lesson'))
+sys.path.insert(0, lesson_dir)
+os.chdir(lesson_dir)
+
+from controller import config, logger
+import model
+import version
+import controller.core_version  # @UnusedImport
+
+def main():
+    parser = argparse.ArgumentParser(description='Upgrade the LESSON database')
+    parser.add_argument('--check', action='store_true', help="only check whether the database is up to date")
+    args = parser.parse_args()
+
+    file_config = config.get_file_config()
+    logger.configure(file_config)
+    engine = unicode(file_config.get('Main', 'database'))
+    db = model.Session(engine, **config.get_database_options(file_config))
+
+    (good_version, error) = version.check_versions(db, file_config.get('Main', 'script dir'),
+                                                   upgrade=not args.check)
+    if not good_version:
+        sys.stderr.write(error.encode('utf-8') + '\n')
+        sys.exit(1)
+
+    stamp = config.get_file_option(file_config, 'Main', 'version stamp', u'config/version.stamp')
+    if stamp:
+        try:
+            version.write_stamp(stamp, engine)
+        except (IOError, OSError), e:
+            sys.stderr.write("Unable to write version stamp '%s': %s\n" % (stamp, e))
+            sys.exit(1)
+    print "Database is up to date"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+controller.auth
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+import hmac, hashlib, os, time, base64, binascii
+from datetime import datetime
+
+from sqlalchemy import event
+
+from controller import password, config
+from controller.cache import Cache, LocalBackend
+from controller.logger import get_logger
+
+_logger = get_logger(__name__)
+
+# Generation that every cached credential depends on
+_ALL = '*'
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+class CredentialCache(object):
+    """
+    Bounded cache of username/password pairs that have already been verified
+    against a password hash.  Entries are keyed on an HMAC of the credentials,
+    so plaintext passwords are never kept in memory, and each entry remembers
+    the hash it was verified against, so a changed password is never accepted
+    from the cache.
+
+    Only successful verifications are cached.  Keys derived from passwords
+    shouldn't leave the process, so this cache is always kept locally.
+    """
+
+    def __init__(self, size=1024, ttl=300, secret=None):
+        self.size = size
+        self.ttl = ttl
+        if secret is None:
+            secret = os.urandom(32)
+        self.secret = secret
+        self._cache = Cache(LocalBackend(items=size), 'credential', ttl)
+
+    def _key(self, username, passwd):
+        return hmac.new(self.secret, '%s\0%s' % (_to_bytes(username), _to_bytes(passwd)),
+                        hashlib.sha256).hexdigest()
+
+    def validate(self, username, passwd, pwhash):
+        """
+        Return True if passwd matches pwhash for username, only running the
+        password hash when the pair isn't already in the cache
+        """
+        if pwhash is None:
+            return False
+
+        key = self._key(username, passwd)
+        # Entries are out of date if the user has been invalidated since
+        generations = self._cache.generations([_to_bytes(username), _ALL])
+        if self._cache.get(key, lambda entry: entry == (pwhash, generations)) is not None:
+            return True
+
+        if not password.validate(passwd, pwhash):
+            return False
+        if self.size > 0:
+            self._cache.set(key, (pwhash, generations))
+        return True
+
+    def invalidate(self, username=None):
+        """
+        Make all cached credentials for username out of date, or all cached
+        credentials if username is None
+        """
+        if username is None:
+            self._cache.invalidate(_ALL)
+        else:
+            self._cache.invalidate(_to_bytes(username))
+
+    def watch(self, user_class):
+        """
+        Invalidate cached credentials whenever a user's password is changed or
+        the user is deleted through this process
+        """
+        def password_set(target, value, oldvalue, initiator):  # @UnusedVariable
+            if value != oldvalue and target.Username is not None:
+                self.invalidate(target.Username)
+
+        def user_deleted(mapper, connection, target):  # @UnusedVariable
+            self.invalidate(target.Username)
+
+        event.listen(user_class.Password, 'set', password_set)
+        event.listen(user_class, 'after_delete', user_deleted)
+
+    def counters(self):
+        """
+        Return tuple of (hits, misses) in this process
+        """
+        return self._cache.counters()
+
+    def stats(self):
+        """
+        Return dictionary of cache counters
+        """
+        return self._cache.stats()
+
+class UserCache(object):
+    """
+    Bounded cache of detached user objects, used so that token
+    authentication doesn't need to query the user table on every request.
+    Cached users are merged into the caller's session without loading them
+    from the database.  Users include their password hashes, so like
+    CredentialCache, this cache is always kept locally, and users changed by
+    other processes are only reloaded once they expire.
+    """
+
+    def __init__(self, db, user_class, size=1024, ttl=60):
+        self.db = db
+        self.user_class = user_class
+        self.size = size
+        self._cache = Cache(LocalBackend(items=size), 'user', ttl)
+
+    def get(self, session, username):
+        """
+        Return user with username attached to session, or None if the user
+        doesn't exist
+        """
+        username = _to_bytes(username)
+        user = self._cache.get(username)
+        if user is None:
+            load_session = self.db.create_session()
+            try:
+                user = load_session.query(self.user_class).get(username.decode('utf-8'))
+            finally:
+                load_session.close()
+            if user is None:
+                return None
+            if self.size > 0:
+                self._cache.set(username, user)
+        return session.merge(user, load=False)
+
+    def invalidate(self, username):
+        self._cache.delete(_to_bytes(username))
+
+    def watch(self, user_class):
+        """
+        Invalidate cached users whenever they are changed or deleted through
+        this process
+        """
+        def user_changed(mapper, connection, target):  # @UnusedVariable
+            self.invalidate(target.Username)
+
+        event.listen(user_class, 'after_update', user_changed)
+        event.listen(user_class, 'after_delete', user_changed)
+
+    def counters(self):
+        """
+        Return tuple of (hits, misses) in this process
+        """
+        return self._cache.counters()
+
+    def stats(self):
+        """
+        Return dictionary of cache counters
+        """
+        return self._cache.stats()
+
+class TokenSigner(object):
+    """
+    Issues and checks signed bearer tokens in the form
+    base64(username:expiry:signature).  The signature covers the user's
+    current password hash, so changing a password revokes all of that user's
+    tokens.
+
+    The secret must be the same in every backend process.
+    """
+
+    def __init__(self, secret, lifetime=3600):
+        self.secret = _to_bytes(secret)
+        self.lifetime = lifetime
+
+    def _sign(self, username, expiry, pwhash):
+        if pwhash is None:
+            pwhash = ''
+        return hmac.new(self.secret, '%s\0%i\0%s' % (_to_bytes(username), expiry, _to_bytes(pwhash)),
+                        hashlib.sha256).hexdigest()
+
+    def issue(self, user):
+        """
+        Return tuple of (token, expiry time) for user
+        """
+        expiry = int(time.time()) + self.lifetime
+        username = _to_bytes(user.Username)
+        token = '%s:%i:%s' % (username, expiry, self._sign(username, expiry, user.Password))
+        return (unicode(base64.urlsafe_b64encode(token)), datetime.fromtimestamp(expiry))
+
+    def parse(self, token):
+        """
+        Return tuple of (username, expiry, signature) from token, or None if
+        token is malformed or has expired.  The signature still needs to be
+        checked using check()
+        """
+        try:
+            (username, expiry, signature) = base64.urlsafe_b64decode(_to_bytes(token)).rsplit(':', 2)
+            expiry = int(expiry)
+        except (TypeError, ValueError, binascii.Error):
+            return None
+        if expiry < time.time():
+            return None
+        return (username, expiry, signature)
+
+    def check(self, parsed_token, pwhash):
+        """
+        Return True if the token returned by parse() was signed for the user's
+        current password hash
+        """
+        (username, expiry, signature) = parsed_token
+        return hmac.compare_digest(self._sign(username, expiry, pwhash), signature)
+
+def get_token_secret(file_config):
+    """
+    Return the token signing secret from the configuration file, or None if
+    it isn't set, in which case bearer tokens are disabled.  The secret is
+    only kept there, as anything in the database can be served by a page.
+    """
+    secret = config.get_file_option(file_config, 'Auth', 'token secret')
+    if not secret:
+        _logger.warning(u"No 'token secret' set in the [Auth] section of the configuration file, so bearer "
+                        u"tokens are disabled.  Set it to a long random string, such as the output of "
+                        u"'openssl rand -hex 32', to enable them.")
+        return None
+    return secret
@@ -0,0 +1,500 @@
+"""
+controller.cache
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+# Cache backends.  LocalBackend keeps values in this process, and
+# MemcachedBackend keeps them in memcached so they're shared by every
+# backend process.  Both have the same interface:
+#
+#   get(key), get_multi(keys), set(key, value, ttl), add(key, value, ttl),
+#   delete(key), incr(key, delta), stats()
+#
+# Keys are byte strings and a ttl of 0 never expires.  Values mustn't be
+# changed once they're cached.  LocalBackend keeps any value as it is, but
+# MemcachedBackend only stores byte strings, integers and values that can be
+# written as JSON.  Anyone who can reach memcached can change what's in it,
+# so nothing is ever unpickled from it, and values written as JSON come back
+# as decoded JSON, with lists for tuples and unicode for strings.
+#
+# Cache is what the caches in the rest of the backend use.  It prefixes
+# keys with its name, counts hits and misses, and keeps generation counters
+# so groups of entries can be invalidated without knowing their keys.
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import cPickle as pickle
+import hashlib, socket, sys, threading, time, zlib
+from collections import OrderedDict
+
+from controller import config
+from controller.logger import get_logger
+
+_logger = get_logger(__name__)
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _size(value):
+    """
+    Return rough size of value in bytes
+    """
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (tuple, list)):
+        return sum(_size(item) for item in value)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+class LocalBackend(object):
+    """
+    Values kept in this process, evicting the least recently used when there
+    are more than items entries or they take up more than size bytes.
+    Either limit may be None.
+    """
+    shared = False
+
+    def __init__(self, size=None, items=None):
+        self.size = size
+        self.items = items
+        self.used = 0
+        self.evictions = 0
+        # key -> (value, expiry, size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        """
+        Must be called with self._lock held
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] and entry[1] <= now:
+            self._remove(key)
+            return None
+        # Move entry to the end so it's evicted last
+        self._entries[key] = self._entries.pop(key)
+        return entry[0]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.used -= entry[2]
+
+    def _store(self, key, value, ttl):
+        """
+        Must be called with self._lock held
+        """
+        size = 0
+        if self.size is not None:
+            size = _size(value)
+            if size > self.size:
+                if key in self._entries:
+                    self._remove(key)
+                return
+        if key in self._entries:
+            self._remove(key)
+        expiry = 0
+        if ttl:
+            expiry = time.time() + ttl
+        self._entries[key] = (value, expiry, size)
+        self.used += size
+        while ((self.size is not None and self.used > self.size) or
+               (self.items is not None and len(self._entries) > self.items)):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.time())
+
+    def get_multi(self, keys):
+        now = time.time()
+        values = {}
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    values[key] = value
+        return values
+
+    def set(self, key, value, ttl=0):
+        with self._lock:
+            self._store(key, value, ttl)
+        return True
+
+    def add(self, key, value, ttl=0):
+        with self._lock:
+            if self._get(key, time.time()) is not None:
+                return False
+            self._store(key, value, ttl)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            entry = self._entries.get(key)
+            value = self._get(key, time.time())
+            if value is None:
+                return None
+            value += delta
+            self._entries[key] = (value, entry[1], entry[2])
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.used = 0
+
+    def stats(self):
+        with self._lock:
+            return {u'size': len(self._entries), u'bytes': self.used, u'evictions': self.evictions}
+
+# Flags stored with memcached values, saying how to decode them
+_FLAG_STR = 0
+_FLAG_INT = 2
+_FLAG_JSON = 3
+
+class MemcachedError(Exception):
+    pass
+
+class MemcachedBackend(object):
+    """
+    Values kept in one or more memcached servers, using the text protocol.
+    Keys are spread over servers by hash.  A server that can't be reached is
+    skipped for retry seconds, and lookups on it miss, so the backend keeps
+    working (more slowly) without it.
+    """
+    shared = True
+
+    def __init__(self, servers, prefix='', timeout=1.0, retry=30):
+        self.servers = []
+        for server in servers:
+            (host, _sep, port) = server.strip().rpartition(':')
+            if not host:
+                (host, port) = (port, '11211')
+            self.servers.append((host, int(port)))
+        if not self.servers:
+            raise ValueError("No memcached servers given")
+        self.prefix = _to_bytes(prefix)
+        self.timeout = timeout
+        self.retry = retry
+        self.errors = 0
+        self._dead = {}
+        self._local = threading.local()
+
+    def _key(self, key):
+        key = self.prefix + _to_bytes(key)
+        if len(key) > 250 or any(ord(c) <= 32 or ord(c) == 127 for c in key):
+            key = self.prefix + 'sha1:' + hashlib.sha1(key).hexdigest()
+        return key
+
+    def _server(self, key):
+        return self.servers[(zlib.crc32(key) & 0xffffffff) % len(self.servers)]
+
+    def _connection(self, server):
+        """
+        Return (socket, file) connected to server for this thread, or None
+        if server is marked as dead
+        """
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        connection = connections.get(server)
+        if connection is not None:
+            return connection
+        if self._dead.get(server, 0) > time.time():
+            return None
+        try:
+            sock = socket.create_connection(server, self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error, e:
+            self._failed(server, e)
+            return None
+        connection = (sock, sock.makefile('rb'))
+        connections[server] = connection
+        return connection
+
+    def _failed(self, server, error):
+        self.errors += 1
+        self._dead[server] = time.time() + self.retry
+        _logger.warning(u"Unable to use memcached server %s:%i: %s", server[0], server[1], error)
+        connection = getattr(self._local, 'connections', {}).pop(server, None)
+        if connection is not None:
+            for item in (connection[1], connection[0]):
+                try:
+                    item.close()
+                except socket.error:
+                    pass
+
+    def _call(self, server, request, reader):
+        """
+        Send request to server and return reader(file), or None if the
+        server can't be used
+        """
+        connection = self._connection(server)
+        if connection is None:
+            return None
+        try:
+            connection[0].sendall(request)
+            return reader(connection[1])
+        except (socket.error, MemcachedError, EOFError, ValueError), e:
+            self._failed(server, e)
+            return None
+
+    @staticmethod
+    def _readline(f):
+        line = f.readline()
+        if not line.endswith('\r\n'):
+            raise EOFError("Connection closed")
+        line = line[:-2]
+        if line == 'ERROR' or line.startswith('CLIENT_ERROR'):
+            raise MemcachedError(line)
+        return line
+
+    def _read_stored(self, f):
+        line = self._readline(f)
+        if line.startswith('SERVER_ERROR'):
+            # Usually a value that's too big to cache, which isn't a reason
+            # to stop using the server
+            _logger.debug(u"Value not stored in memcached: %s", line)
+        return line
+
+    @staticmethod
+    def _encode(value):
+        if isinstance(value, str):
+            return (_FLAG_STR, value)
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            return (_FLAG_INT, str(value))
+        return (_FLAG_JSON, json.dumps(value, separators=(',', ':')))
+
+    @staticmethod
+    def _decode(flags, data):
+        if flags == _FLAG_STR:
+            return data
+        if flags == _FLAG_INT:
+            return int(data)
+        if flags == _FLAG_JSON:
+            return json.loads(data)
+        raise ValueError("Unknown flags %i" % (flags,))
+
+    def _read_values(self, f):
+        values = {}
+        while True:
+            line = self._readline(f)
+            if line == 'END':
+                return values
+            (_value, key, flags, length) = line.split(' ')[:4]
+            data = f.read(int(length) + 2)
+            if len(data) != int(length) + 2:
+                raise EOFError("Connection closed")
+            values[key] = (int(flags), data[:-2])
+
+    def get(self, key):
+        return self.get_multi([key]).get(key)
+
+    def get_multi(self, keys):
+        by_server = {}
+        originals = {}
+        for key in keys:
+            full_key = self._key(key)
+            originals[full_key] = key
+            by_server.setdefault(self._server(full_key), []).append(full_key)
+
+        values = {}
+        for (server, server_keys) in by_server.items():
+            found = self._call(server, 'get %s\r\n' % (' '.join(server_keys),), self._read_values)
+            if not found:
+                continue
+            for (full_key, (flags, data)) in found.items():
+                try:
+                    values[originals[full_key]] = self._decode(flags, data)
+                except Exception, e:
+                    _logger.warning(u"Unable to decode cached value for %s: %s", full_key, e)
+        return values
+
+    def _store(self, command, key, value, ttl):
+        key = self._key(key)
+        try:
+            (flags, data) = self._encode(value)
+        except (TypeError, ValueError), e:
+            _logger.debug(u"Value for %s can't be stored in memcached: %s", key, e)
+            return False
+        request = '%s %s %i %i %i\r\n%s\r\n' % (command, key, flags, int(ttl), len(data), data)
+        return self._call(self._server(key), request, self._read_stored) == 'STORED'
+
+    def set(self, key, value, ttl=0):
+        return self._store('set', key, value, ttl)
+
+    def add(self, key, value, ttl=0):
+        return self._store('add', key, value, ttl)
+
+    def delete(self, key):
+        key = self._key(key)
+        self._call(self._server(key), 'delete %s\r\n' % (key,), self._readline)
+
+    def incr(self, key, delta=1):
+        key = self._key(key)
+        result = self._call(self._server(key), 'incr %s %i\r\n' % (key, delta), self._readline)
+        if result is None or result == 'NOT_FOUND':
+            return None
+        return int(result)
+
+    def clear(self):
+        for server in self.servers:
+            self._call(server, 'flush_all\r\n', self._readline)
+
+    def stats(self):
+        items = 0
+        used = 0
+        evictions = 0
+        for server in self.servers:
+            def read_stats(f):
+                stats = {}
+                while True:
+                    line = self._readline(f)
+                    if line == 'END':
+                        return stats
+                    (_stat, name, value) = line.split(' ', 2)
+                    stats[name] = value
+            stats = self._call(server, 'stats\r\n', read_stats) or {}
+            items += int(stats.get('curr_items', 0))
+            used += int(stats.get('bytes', 0))
+            evictions += int(stats.get('evictions', 0))
+        return {u'size': items, u'bytes': used, u'evictions': evictions, u'errors': self.errors}
+
+_memcached = {}
+_memcached_lock = threading.Lock()
+
+def create_backend(file_config, size=None, items=None):
+    """
+    Return backend set by 'backend' in the [Cache] section of the
+    configuration file.  A local backend is limited to size bytes and items
+    entries, while memcached enforces its own limit, so every cache in a
+    process shares one memcached backend.
+    """
+    backend = config.get_file_option(file_config, 'Cache', 'backend', 'local')
+    if backend == 'local':
+        return LocalBackend(size, items)
+    if backend != 'memcached':
+        _logger.error(u"Unknown cache backend '%s' in section [Cache] of configuration file", backend)
+        sys.exit(1)
+
+    servers = config.get_file_option(file_config, 'Cache', 'servers', '127.0.0.1:11211')
+    prefix = config.get_file_option(file_config, 'Cache', 'prefix', 'lesson:')
+    timeout = config.get_file_option(file_config, 'Cache', 'timeout', 1.0, float)
+    settings = (servers, prefix, timeout)
+    with _memcached_lock:
+        if settings not in _memcached:
+            _memcached[settings] = MemcachedBackend(servers.split(','), prefix, timeout)
+        return _memcached[settings]
+
+def _initial_generation():
+    # A counter that's been evicted must never start again at a value it's
+    # already had, so new counters start at the time in milliseconds
+    return int(time.time() * 1000)
+
+class Cache(object):
+    """
+    Entries under name in backend, with hit and miss counters for this
+    process
+    """
+
+    def __init__(self, backend, name, ttl=0):
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return '%s:%s' % (self.name, _to_bytes(key))
+
+    def get(self, key, check=None):
+        """
+        Return value cached for key, or None.  If check is given, values
+        for which check(value) is False are out of date and are dropped.
+        """
+        value = self.backend.get(self._key(key))
+        if value is not None and check is not None and not check(value):
+            self.backend.delete(self._key(key))
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        return self.backend.set(self._key(key), value, ttl)
+
+    def delete(self, key):
+        self.backend.delete(self._key(key))
+
+    def generations(self, groups):
+        """
+        Return tuple of the current generation of each group in groups.
+        Entries should store the generations they were built from, and are
+        out of date once any of them has changed.
+        """
+        keys = [self._key('generation:%s' % (_to_bytes(group),)) for group in groups]
+        found = self.backend.get_multi(keys)
+        for key in keys:
+            if key not in found:
+                self.backend.add(key, _initial_generation())
+                found[key] = self.backend.get(key)
+        return tuple(found[key] for key in keys)
+
+    def invalidate(self, group):
+        """
+        Make every entry built from group out of date
+        """
+        key = self._key('generation:%s' % (_to_bytes(group),))
+        if self.backend.incr(key) is None:
+            if not self.backend.add(key, _initial_generation()):
+                self.backend.incr(key)
+
+    def counters(self):
+        """
+        Return tuple of (hits, misses) in this process
+        """
+        return (self.hits, self.misses)
+
+    def stats(self):
+        """
+        Return dictionary of cache counters.  Sizes are for the whole
+        backend, which may be shared with other caches, and may need a
+        round trip to each memcached server.
+        """
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            ratio = float(self.hits) / lookups
+        else:
+            ratio = 0.0
+        stats = {u'hits': self.hits, u'misses': self.misses, u'hit_ratio': ratio}
+        stats.update(self.backend.stats())
+        return stats
@@ -0,0 +1,64 @@
+"""
+controller.conditional
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import hashlib
+
+def etag(payload, variant, default):
+    """
+    Return strong ETag for a page's payload before it's rendered, or None if
+    the payload can't be hashed (such as when it streams from the database).
+    variant is anything else that changes the rendered response, such as
+    the requested format, and default is the JSON handler for values like
+    dates.
+    """
+    digest = hashlib.sha1()
+    try:
+        digest.update(json.dumps([payload, variant], default=default, sort_keys=True))
+    except (TypeError, ValueError):
+        return None
+    return '"%s"' % (digest.hexdigest(),)
+
+def _matches(header, tag):
+    """
+    Return True if If-None-Match header lists tag.  GET requests use weak
+    comparison, so W/ prefixes are ignored.
+    """
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == tag:
+            return True
+    return False
+
+def not_modified(env, tag):
+    """
+    Return True if the request in WSGI environment env already has the
+    response with ETag tag.  Payloads don't carry modification times, so
+    Last-Modified isn't sent and If-Modified-Since is ignored.
+    """
+    if_none_match = env.get('HTTP_IF_NONE_MATCH')
+    return if_none_match is not None and _matches(if_none_match, tag)
@@ -19,9 +19,12 @@ Copyright (C) 2012 Jonathan Dieter <jdieter@lesbg.com>
 
 
 
-import ConfigParser, os, sys
+import ConfigParser, binascii, os, sys, threading, time
 
 from model.core import Config as DBConfig, uuid as core_uuid
+from controller.logger import get_logger
+
+_logger = get_logger(__name__)
 
 def get_file_config():
     """
@@ -33,19 +36,64 @@ def get_file_config():
             config_path = path
             break
     if config_path is None:
-        create_file_config('config/lesson.conf')
+        create_file_config('config/lesson.conf', unicode(binascii.hexlify(os.urandom(32))))
         config_path = 'config/lesson.conf'
     config = ConfigParser.SafeConfigParser()
     try:
         config.read(config_path)
     except:
-        print u"ERROR: Unable to read configuration file at %s" % (config_path,)
+        _logger.error(u"Unable to read configuration file at %s", config_path)
         sys.exit(1)
     return config
 
-def create_file_config(path):
+def get_file_option(config, section, option, default=None, conv=None):
+    """
+    Return option in section of file configuration, converted using conv if
+    it isn't None.  If either section or option doesn't exist, return default.
     """
-    Create configuration file at path
+    if not config.has_option(section, option):
+        return default
+    value = config.get(section, option)
+    if conv is not None:
+        try:
+            value = conv(value)
+        except ValueError:
+            _logger.error(u"Invalid value '%s' for '%s' in section [%s] of configuration file", value, option, section)
+            sys.exit(1)
+    return value
+
+def boolean(value):
+    if value.lower() in ('1', 'yes', 'true', 'on'):
+        return True
+    if value.lower() in ('0', 'no', 'false', 'off'):
+        return False
+    raise ValueError("Not a boolean: %s" % (value,))
+
+def get_database_options(config):
+    """
+    Return dictionary of create_engine() options from the Database section of
+    file configuration.  Options that are empty or missing are left at the
+    database driver's default, except for 'pool recycle', which defaults to an
+    hour.  'pool pre ping' is only passed on when it's turned on, as older
+    versions of SQLAlchemy don't support it
+    """
+    options = {'pool_recycle': 3600}
+    for (option, name, conv) in (('pool size', 'pool_size', int),
+                                 ('max overflow', 'max_overflow', int),
+                                 ('pool timeout', 'pool_timeout', float),
+                                 ('pool recycle', 'pool_recycle', int),
+                                 ('pool pre ping', 'pool_pre_ping', boolean),
+                                 ('isolation level', 'isolation_level', str)):
+        if get_file_option(config, 'Database', option, '') != '':
+            options[name] = get_file_option(config, 'Database', option, conv=conv)
+    if options.get('pool_pre_ping') is False:
+        del options['pool_pre_ping']
+    return options
+
+def create_file_config(path, token_secret=u''):
+    """
+    Create configuration file at path.  If token_secret is set, the file
+    is only readable by its owner.
     """
     config = ConfigParser.RawConfigParser()
     config.add_section('Main')
@@ -53,21 +101,212 @@ def create_file_config(path):
     config.set('Main', 'database',
                u'mysql+mysqldb://test.example.com/lesson?charset=utf8')
     config.set('Main', 'script dir', u'scripts')
+    config.set('Main', 'route manifest', u'view/manifest.json')
+    config.set('Main', 'version stamp', u'config/version.stamp')
+
+    config.add_section('Database')
+    config.set('Database', 'pool size', u'')
+    config.set('Database', 'max overflow', u'')
+    config.set('Database', 'pool timeout', u'')
+    config.set('Database', 'pool recycle', u'3600')
+    config.set('Database', 'pool pre ping', u'no')
+    config.set('Database', 'isolation level', u'')
+
+    config.add_section('Auth')
+    config.set('Auth', 'credential cache size', u'1024')
+    config.set('Auth', 'credential cache ttl', u'300')
+    config.set('Auth', 'user cache ttl', u'60')
+    config.set('Auth', 'token lifetime', u'3600')
+    config.set('Auth', 'token secret', token_secret)
+
+    config.add_section('Log')
+    config.set('Log', 'queue size', u'10000')
+    config.set('Log', 'batch size', u'100')
+    config.set('Log', 'flush interval', u'1.0')
+    config.set('Log', 'overflow', u'block')
+    config.set('Log', 'spill file', u'')
+    config.set('Log', 'ignore host ttl', u'60')
+
+    config.add_section('Cache')
+    config.set('Cache', 'backend', u'local')
+    config.set('Cache', 'servers', u'127.0.0.1:11211')
+    config.set('Cache', 'prefix', u'lesson:')
+    config.set('Cache', 'timeout', u'1.0')
+    config.set('Cache', 'config ttl', u'60')
+    config.set('Cache', 'response cache size', u'8388608')
+
+    config.add_section('Timing')
+    config.set('Timing', 'server timing', u'no')
+    config.set('Timing', 'slow request threshold', u'1.0')
+    config.set('Timing', 'slow request file', u'')
+
+    config.add_section('Metrics')
+    config.set('Metrics', 'directory', u'')
+    config.set('Metrics', 'update interval', u'5.0')
+
+    config.add_section('Logging')
+    config.set('Logging', 'level', u'warning')
+    config.set('Logging', 'format', u'')
+    config.set('Logging', 'file', u'')
 
     if not os.path.exists(os.path.dirname(path)):
         try:
             os.makedirs(os.path.dirname(path), 0700)
         except:
-            print u"ERROR: Unable to create directory '%s' for configuration file." % (os.path.dirname(path),)
+            _logger.error(u"Unable to create directory '%s' for configuration file.", os.path.dirname(path))
             sys.exit(1)
+    mode = 0666
+    if token_secret:
+        mode = 0600
     try:
-        configfile = open(path, 'wb')
+        configfile = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb')
     except:
-        print u"ERROR: Unable to open configuration file '%s' for writing." % (path,)
+        _logger.error(u"Unable to open configuration file '%s' for writing.", path)
         sys.exit(1)
     config.write(configfile)
     configfile.close()
 
+class ConfigCache(object):
+    """
+    Process-wide copy of the config table, keyed on (UUID, Key).  The whole
+    table is loaded in one query, so a key that isn't in the cache is known
+    not to exist and doesn't need another query.  The table is reloaded after
+    ttl seconds so that changes made by other processes are picked up.  A ttl
+    of 0 disables the cache.
+
+    If shared is set, it's a controller.cache.Cache in a backend shared with
+    other processes.  Copies of the table are kept there, so each process
+    reloads from the shared copy rather than the database, which is only
+    queried once the shared copy has expired or the table has been changed.
+
+    As the whole table is loaded, a key that isn't in it is as much a hit as
+    one that is, so only reloads count as misses.
+    """
+
+    def __init__(self, ttl=60, shared=None):
+        self.ttl = ttl
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self._values = {}
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return self.ttl > 0
+
+    def fresh(self):
+        return self._expires > time.time()
+
+    def load(self, session):
+        """
+        Load every row in the config table, from the shared copy if there's
+        a current one
+        """
+        values = None
+        if self.shared is not None:
+            shared_key = 'table:%s' % (self.shared.generations(['table'])[0],)
+            rows = self.shared.get(shared_key)
+            if rows is not None:
+                # The shared copy is a list of [uuid, key, value] rows, as
+                # JSON can't have tuples as keys
+                values = dict(((uuid, key), value) for (uuid, key, value) in rows)
+        if values is None:
+            values = {}
+            query = session.query(DBConfig.UUID, DBConfig.Key, DBConfig.Value).order_by(DBConfig.ConfigIndex)
+            for (uuid, key, value) in query:
+                # Match get_config(), which returns the first matching row
+                values.setdefault((uuid, key), value)
+            if self.shared is not None:
+                self.shared.set(shared_key, [[uuid, key, value] for ((uuid, key), value) in values.items()],
+                                self.ttl)
+            with self._lock:
+                self.loads += 1
+        with self._lock:
+            self._values = values
+            self._expires = time.time() + self.ttl
+            self.misses += 1
+
+    def get(self, uuid, key, fallback=True):
+        """
+        Return value for uuid, key.  If it isn't in the table and fallback is
+        set, return value for core uuid, key, and if that isn't either,
+        return None.
+        """
+        values = self._values
+        value = values.get((uuid, key), _ABSENT)
+        if value is _ABSENT and fallback:
+            value = values.get((core_uuid, key), _ABSENT)
+        self.hits += 1
+        if value is _ABSENT:
+            return None
+        return value
+
+    def set(self, uuid, key, value):
+        with self._lock:
+            # Cached tables may be shared, so they're copied, not changed
+            values = dict(self._values)
+            values[(uuid, key)] = value
+            self._values = values
+        if self.shared is not None:
+            # Other processes reload the table once their copy expires
+            self.shared.invalidate('table')
+
+    def invalidate(self):
+        with self._lock:
+            self._expires = 0
+
+    def counters(self):
+        """
+        Return tuple of (hits, misses) in this process
+        """
+        return (self.hits, self.misses)
+
+    def stats(self):
+        """
+        Return dictionary of cache counters
+        """
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            ratio = float(self.hits) / lookups
+        else:
+            ratio = 0.0
+        return {u'hits': self.hits, u'misses': self.misses, u'loads': self.loads,
+                u'size': len(self._values), u'hit_ratio': ratio}
+
+# Value returned by dict.get() for keys that aren't in the config table, as
+# a row's value may be None
+_ABSENT = object()
+
+cache = ConfigCache()
+
+def configure_cache(ttl, shared=None):
+    """
+    Set how long the config cache is used before it is reloaded, and the
+    controller.cache.Cache it's shared with other processes through, if any
+    """
+    cache.ttl = ttl
+    cache.shared = shared
+    cache.invalidate()
+
+def load_config(session):
+    """
+    Load the whole config table into the config cache
+    """
+    if cache.enabled():
+        cache.load(session)
+
+def get_cached_config(uuid, key, fallback=True):
+    """
+    Return tuple of (cached, value) for pair uuid, key using only the config
+    cache.  If cached is False, the cache is disabled or needs reloading and
+    get_config() has to be used instead.
+    """
+    if not cache.enabled() or not cache.fresh():
+        return (False, None)
+    return (True, cache.get(uuid, key, fallback))
+
 def get_config(session, uuid, key, fallback=True):
     """
     Return configuration value for pair uuid, key.  If pair uuid, key doesn't
@@ -78,6 +317,11 @@ def get_config(session, uuid, key, fallback=True):
     if isinstance(key, str):
         raise ValueError("Key '%s' is not unicode" % (key,))
 
+    if cache.enabled():
+        if not cache.fresh():
+            cache.load(session)
+        return cache.get(uuid, key, fallback)
+
     item = session.query(DBConfig).filter_by(UUID=uuid, Key=key).first()
 
     if item is not None:
@@ -106,3 +350,5 @@ def set_config(session, uuid, key, value):
         item = DBConfig(UUID=uuid, Key=key, Value=value)
         session.add(item)
     session.commit()
+    if cache.enabled():
+        cache.set(uuid, key, value)
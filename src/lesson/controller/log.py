@@ -17,21 +17,294 @@ Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 Copyright (C) 2012 Jonathan Dieter <jdieter@lesbg.com>
 """
 
+import Queue, threading, time, atexit, os, json, socket, binascii
+from datetime import datetime
+
+from sqlalchemy import event
+
 from model.core import Log as DBLog, LogIgnoreHost, User
+from controller.logger import get_logger
+
+_logger = get_logger(__name__)
 
 NONE = 0
 ERROR = 1
 INFO = 3
 DEBUG = 10
 
+# What LogWriter does when its queue is full
+BLOCK = 'block'
+DROP = 'drop'
+SPILL = 'spill'
+
+_STOP = object()
+
+class LogWriter(object):
+    """
+    Writes log rows to the database from a background thread.  Rows are
+    queued by put() and inserted in batches of up to batch_size rows, or
+    whatever has arrived after flush_interval seconds.
+
+    When the queue is full, overflow decides whether put() blocks (BLOCK),
+    throws the row away (DROP) or appends it to spill_file as a line of JSON
+    (SPILL).  Rows that can't be written to the database are also appended to
+    spill_file if it is set.
+
+    The queue is flushed when the process exits.
+    """
+
+    def __init__(self, db, queue_size=10000, batch_size=100, flush_interval=1.0,
+                 overflow=BLOCK, spill_file=None):
+        if overflow not in (BLOCK, DROP, SPILL):
+            raise ValueError("Unknown log overflow policy '%s'" % (overflow,))
+        if overflow == SPILL and spill_file is None:
+            raise ValueError("Log overflow policy 'spill' needs a spill file")
+        self.db = db
+        self.queue = Queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_file = spill_file
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _start(self):
+        # Start worker on first use, and again if we've been forked, as
+        # threads don't survive a fork
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='LogWriter')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def put(self, row):
+        """
+        Queue row (a dictionary of log table columns) for writing
+        """
+        self._start()
+        try:
+            self.queue.put_nowait(row)
+        except Queue.Full:
+            if self.overflow == BLOCK:
+                self.queue.put(row)
+            elif self.overflow == DROP:
+                self.dropped += 1
+            else:
+                self._spill([row])
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                self.queue.task_done()
+                return
+            batch = [item]
+            stop = False
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+            for item in batch:
+                self.queue.task_done()
+            if stop:
+                self.queue.task_done()
+                return
+
+    def _write(self, batch):
+        session = self.db.create_session()
+        try:
+            session.execute(DBLog.__table__.insert(), batch)
+            session.commit()
+            self.written += len(batch)
+        except Exception, e:
+            session.rollback()
+            _logger.error(u"Unable to write %i log entries: %s", len(batch), e)
+            if self.spill_file is not None:
+                self._spill(batch)
+            else:
+                self.dropped += len(batch)
+        finally:
+            session.close()
+
+    def _spill(self, rows):
+        with self._spill_lock:
+            try:
+                spill = open(self.spill_file, 'a')
+            except IOError, e:
+                _logger.error(u"Unable to open log spill file %s: %s", self.spill_file, e)
+                self.dropped += len(rows)
+                return
+            try:
+                for row in rows:
+                    row = dict(row)
+                    row['Time'] = row['Time'].isoformat()
+                    spill.write(json.dumps(row) + '\n')
+                self.spilled += len(rows)
+            finally:
+                spill.close()
+
+    def depth(self):
+        """
+        Return number of rows waiting to be written
+        """
+        return self.queue.qsize()
+
+    def flush(self):
+        """
+        Block until every queued row has been written
+        """
+        if self._thread is not None and self._pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        """
+        Write any queued rows and stop the worker thread
+        """
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        self._thread.join()
+
+def _parse_address(address):
+    """
+    Return tuple of (address bits, address as integer) for an IPv4 or IPv6
+    address, or None if address isn't an IP address
+    """
+    if isinstance(address, unicode):
+        address = address.encode('ascii', 'ignore')
+    for family, bits in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+        return (bits, int(binascii.hexlify(packed), 16))
+    return None
+
+class IgnoreHostCache(object):
+    """
+    In-memory copy of the log_ignore_host table, used to decide whether
+    X-Forwarded-For came from a trusted proxy without querying the database.
+
+    HostAddr may be a host name, an address or a network in CIDR notation
+    (for example 10.0.0.0/8).  The table is reloaded after ttl seconds, or
+    straight away if it is changed through this process.
+    """
+
+    def __init__(self, db, ttl=60):
+        self.db = db
+        self.ttl = ttl
+        self.hosts = frozenset()
+        self.networks = {}
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        hosts = set()
+        networks = {}
+        session = self.db.create_session()
+        try:
+            for (host_addr,) in session.query(LogIgnoreHost.HostAddr):
+                host_addr = host_addr.strip()
+                hosts.add(host_addr)
+                (address, _sep, prefix) = host_addr.partition('/')
+                parsed = _parse_address(address)
+                if parsed is None:
+                    continue
+                (bits, address) = parsed
+                try:
+                    prefix = int(prefix) if prefix else bits
+                except ValueError:
+                    continue
+                if prefix < 0 or prefix > bits:
+                    continue
+                networks.setdefault((bits, prefix), set()).add(address >> (bits - prefix))
+        finally:
+            session.close()
+        self.hosts = frozenset(hosts)
+        self.networks = dict((key, frozenset(value)) for key, value in networks.items())
+
+    def refresh(self, force=False):
+        """
+        Reload table if it has expired or force is True
+        """
+        if not force and self._expires > time.time():
+            return
+        with self._lock:
+            if not force and self._expires > time.time():
+                return
+            try:
+                self._load()
+            except Exception, e:
+                # Keep using what we have and try again on the next request
+                _logger.error(u"Unable to load ignored log hosts: %s", e)
+            self._expires = time.time() + self.ttl
+
+    def invalidate(self):
+        self._expires = 0
+
+    def watch(self, table_class):
+        """
+        Reload table on the next lookup whenever it is changed through this
+        process
+        """
+        def table_changed(mapper, connection, target):  # @UnusedVariable
+            self.invalidate()
+
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(table_class, name, table_changed)
+
+    def contains(self, host, address=None):
+        """
+        Return True if host name or address is in the table, either directly or
+        as part of a network
+        """
+        self.refresh()
+        if host in self.hosts or (address is not None and address in self.hosts):
+            return True
+        if address is None or len(self.networks) == 0:
+            return False
+        parsed = _parse_address(address)
+        if parsed is None:
+            return False
+        (bits, address) = parsed
+        for (net_bits, prefix), networks in self.networks.items():
+            if net_bits == bits and (address >> (bits - prefix)) in networks:
+                return True
+        return False
+
 class Log:
     """
     There should be one instance of this class used in the LESSON backend.
     This class is used for logging backend page access.
     """
 
-    def __init__(self, db):
+    def __init__(self, db, writer=None, ignore_hosts=None):
         self.db = db
+        self.writer = writer
+        if ignore_hosts is None:
+            ignore_hosts = IgnoreHostCache(db)
+            ignore_hosts.watch(LogIgnoreHost)
+        self.ignore_hosts = ignore_hosts
 
     def log(self, ctx, page, user, level, comment, record_level=INFO):
         if isinstance(user, unicode):
@@ -44,8 +317,6 @@ class Log:
         if level < 1:
             raise ValueError("Log level can't be log.NONE or negative")
 
-        session = self.db.create_session()
-
         if not 'REMOTE_HOST' in  ctx.environ.keys():
             remote_host = ctx.environ['REMOTE_ADDR'];
         else:
@@ -56,10 +327,8 @@ class Log:
             remote_host = 'localhost'
 
         if 'HTTP_X_FORWARDED_FOR' in ctx.environ.keys():
-            query = session.query(LogIgnoreHost)
-            for item in query:
-                if item.HostAddr == remote_host:
-                    remote_host = None
+            if self.ignore_hosts.contains(remote_host, ctx.environ['REMOTE_ADDR']):
+                remote_host = None
             if remote_host is None:
                 remote_host = ctx.environ['HTTP_X_FORWARDED_FOR']
             else:
@@ -75,8 +344,13 @@ class Log:
             comment = unicode(comment)
 
         if level <= record_level:
-            new_log = DBLog(page, user, level, remote_host, comment)
-            session.add(new_log)
-            session.commit()
-            session.close()
-        print page, username, level, remote_host, comment
+            if self.writer is not None:
+                self.writer.put({'Username': username, 'Level': level, 'Time': datetime.now(),
+                                 'Comment': comment, 'Page': page, 'RemoteHost': remote_host})
+            else:
+                session = self.db.create_session()
+                new_log = DBLog(page, user, level, remote_host, comment)
+                session.add(new_log)
+                session.commit()
+                session.close()
+        _logger.debug("%s %s %s %s %s", page, username, level, remote_host, comment)
@@ -0,0 +1,90 @@
+"""
+controller.logger
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+import logging, sys
+
+# Diagnostic messages for administrators.  These are separate from
+# controller.log, which records user activity in the database.
+
+ROOT = 'lesson'
+DEFAULT_LEVEL = logging.WARNING
+DEFAULT_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Options in [Logging] that aren't module names
+_OPTIONS = ('level', 'format', 'file')
+
+_root = logging.getLogger(ROOT)
+_root.setLevel(DEFAULT_LEVEL)
+_root.propagate = False
+# Until configure() is called, write to stderr (the error log under mod_wsgi)
+_handler = logging.StreamHandler(sys.stderr)
+_handler.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+_root.addHandler(_handler)
+
+def get_logger(name):
+    """
+    Return logger for module name
+    """
+    return logging.getLogger('%s.%s' % (ROOT, name))
+
+def _level(option, value):
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value.upper())
+    if not isinstance(level, int):
+        _root.error(u"Invalid level '%s' for '%s' in section [Logging] of configuration file", value, option)
+        sys.exit(1)
+    return level
+
+def configure(file_config):
+    """
+    Set up logging from the [Logging] section of the configuration file.
+    'level' is the level for all modules, 'format' is the message format and
+    'file' is a file to log to instead of stderr.  Any other option is taken
+    as a module name (such as 'render' or 'controller.log') and sets the
+    level for that module.
+    """
+    global _handler
+
+    if not file_config.has_section('Logging'):
+        return
+
+    for option in file_config.options('Logging'):
+        value = file_config.get('Logging', option, raw=True)
+        if option == 'level':
+            if value:
+                _root.setLevel(_level(option, value))
+        elif option not in _OPTIONS and value:
+            get_logger(option).setLevel(_level(option, value))
+
+    log_file = None
+    if file_config.has_option('Logging', 'file'):
+        log_file = file_config.get('Logging', 'file', raw=True)
+    log_format = DEFAULT_FORMAT
+    if file_config.has_option('Logging', 'format'):
+        log_format = file_config.get('Logging', 'format', raw=True) or DEFAULT_FORMAT
+
+    if log_file:
+        handler = logging.FileHandler(log_file)
+    else:
+        handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter(log_format))
+    _root.removeHandler(_handler)
+    _root.addHandler(handler)
+    _handler = handler
@@ -0,0 +1,308 @@
+"""
+controller.metrics
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+import atexit, errno, mmap, os, shutil, struct, tempfile, threading, time
+
+from controller.logger import get_logger
+
+_logger = get_logger(__name__)
+
+# Request duration histogram buckets, in seconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# (type, help) for every metric that's exported
+METRICS = {
+    'lesson_requests_total': ('counter', 'Requests handled, by page class and status code'),
+    'lesson_request_duration_seconds': ('histogram', 'Time taken to handle requests, by page class'),
+    'lesson_responses_total': ('counter', 'Responses sent, by status code'),
+    'lesson_db_pool_size': ('gauge', 'Database connections kept in the pool'),
+    'lesson_db_pool_checked_out': ('gauge', 'Database connections in use'),
+    'lesson_db_pool_overflow': ('gauge', 'Database connections open beyond the pool size'),
+    'lesson_db_pool_checkout_seconds': ('histogram', 'Time taken to check a database connection out of the pool'),
+    'lesson_log_queue_depth': ('gauge', 'Log rows waiting to be written to the database'),
+    'lesson_startup_seconds': ('gauge', 'Time taken by each phase of process startup, added up over processes'),
+    'lesson_cache_hits_total': ('counter', 'Cache lookups that found an entry'),
+    'lesson_cache_misses_total': ('counter', 'Cache lookups that didn\'t find an entry'),
+    'lesson_cache_hit_ratio': ('gauge', 'Proportion of cache lookups that found an entry'),
+}
+
+# Gauges describe a live process, so they are only added up over processes
+# that are still running
+_GAUGES = set(name for (name, (metric_type, _help)) in METRICS.items() if metric_type == 'gauge')
+
+_HEADER = struct.Struct('<i4x')
+_LENGTH = struct.Struct('<i')
+_VALUE = struct.Struct('<d')
+
+def _read_values(data):
+    """
+    Yield (key, value, position of value) for every value in data read
+    from a values file
+    """
+    used = _HEADER.unpack_from(data, 0)[0]
+    pos = _HEADER.size
+    while pos < used:
+        length = _LENGTH.unpack_from(data, pos)[0]
+        key_end = pos + _LENGTH.size + length
+        value_pos = key_end + (-key_end % 8)
+        key = data[pos + _LENGTH.size:key_end].decode('utf-8')
+        yield (key, _VALUE.unpack_from(data, value_pos)[0], value_pos)
+        pos = value_pos + _VALUE.size
+
+class _ValuesFile(object):
+    """
+    Named values in a memory mapped file, so other processes can read them
+    without asking this one.  Values can be updated without locking as long
+    as only one thread adds to them.  New names are appended to the end of
+    the file, and the used length is only updated once they are complete.
+    """
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        size = os.fstat(self._fd).st_size
+        if size == 0:
+            size = self.INITIAL_SIZE
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._used = _HEADER.unpack_from(self._map, 0)[0]
+        if self._used == 0:
+            self._used = _HEADER.size
+            _HEADER.pack_into(self._map, 0, self._used)
+        self._positions = dict((key, pos) for (key, _value, pos) in _read_values(self._map))
+
+    def _position(self, key):
+        pos = self._positions.get(key)
+        if pos is not None:
+            return pos
+
+        with self._lock:
+            pos = self._positions.get(key)
+            if pos is not None:
+                return pos
+            encoded = key.encode('utf-8')
+            key_end = self._used + _LENGTH.size + len(encoded)
+            pos = key_end + (-key_end % 8)
+            if pos + _VALUE.size > len(self._map):
+                size = len(self._map) * 2
+                while pos + _VALUE.size > size:
+                    size *= 2
+                os.ftruncate(self._fd, size)
+                self._map.close()
+                self._map = mmap.mmap(self._fd, size)
+            _LENGTH.pack_into(self._map, self._used, len(encoded))
+            self._map[self._used + _LENGTH.size:key_end] = encoded
+            _VALUE.pack_into(self._map, pos, 0.0)
+            self._used = pos + _VALUE.size
+            _HEADER.pack_into(self._map, 0, self._used)
+            self._positions[key] = pos
+            return pos
+
+    def add(self, key, amount=1):
+        pos = self._position(key)
+        _VALUE.pack_into(self._map, pos, _VALUE.unpack_from(self._map, pos)[0] + amount)
+
+    def set(self, key, value):
+        _VALUE.pack_into(self._map, self._position(key), value)
+
+def _sample(name, labels=None):
+    """
+    Return sample name with labels in exposition format
+    """
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join('%s="%s"' % (label, unicode(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for (label, value) in labels))
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def _remove_directory(directory, pid):
+    """
+    Remove private metrics directory, unless this is a child process that
+    was forked after it was created and it's still being used
+    """
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+class Metrics(object):
+    """
+    Request counters and process statistics for every backend process that
+    shares directory.  Each thread adds to its own file, so request counters
+    don't need a lock, and each process writes its statistics to its own
+    file.  collect() adds them all up.
+
+    Files are left behind when processes exit so their counts aren't lost,
+    so the directory should be emptied when the web server is restarted.  If
+    directory isn't set, a private directory is used and only this process is
+    counted.  It's removed when the process exits.
+    """
+
+    def __init__(self, directory=None, buckets=REQUEST_BUCKETS):
+        if not directory:
+            directory = tempfile.mkdtemp(prefix='lesson-metrics-')
+            atexit.register(_remove_directory, directory, os.getpid())
+        elif not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self.directory = directory
+        self.buckets = buckets
+        self._local = threading.local()
+        self._process = None
+        self._process_lock = threading.Lock()
+        self._process_updated = 0
+
+    def _thread_values(self):
+        values = getattr(self._local, 'values', None)
+        if values is None or values.pid != os.getpid():
+            values = _ValuesFile(os.path.join(self.directory, 'thread_%i_%i.db' %
+                                              (os.getpid(), threading.current_thread().ident)))
+            self._local.values = values
+        return values
+
+    def _process_values(self):
+        with self._process_lock:
+            if self._process is None or self._process.pid != os.getpid():
+                self._process = _ValuesFile(os.path.join(self.directory, 'process_%i.db' % (os.getpid(),)))
+            return self._process
+
+    def observe_request(self, route, code, duration):
+        """
+        Count a request to page class route that finished with status code
+        after duration seconds
+        """
+        values = self._thread_values()
+        values.add(_sample('lesson_requests_total', (('route', route), ('code', code))))
+        name = 'lesson_request_duration_seconds'
+        for bucket in self.buckets:
+            if duration <= bucket:
+                values.add(_sample(name + '_bucket', (('route', route), ('le', bucket))))
+        values.add(_sample(name + '_bucket', (('route', route), ('le', '+Inf'))))
+        values.add(_sample(name + '_sum', (('route', route),)), duration)
+        values.add(_sample(name + '_count', (('route', route),)))
+
+    def due(self, interval):
+        """
+        Return True if this process's samples were written at least interval
+        seconds ago, so samples only need to be built when they'll be written
+        """
+        return not interval or time.time() - self._process_updated >= interval
+
+    def update_process(self, samples, interval=0):
+        """
+        Write this process's (name, labels, value) samples, unless they were
+        written less than interval seconds ago
+        """
+        now = time.time()
+        if interval and now - self._process_updated < interval:
+            return
+        self._process_updated = now
+        values = self._process_values()
+        # Any thread may write process samples, and adding a new one may
+        # move the file's memory map
+        with self._process_lock:
+            for (name, labels, value) in samples:
+                if value is not None:
+                    values.set(_sample(name, labels), value)
+
+    def collect(self, status_codes=()):
+        """
+        Return every metric from every process in text exposition format.
+        Response counts are always given for status_codes, even if they are
+        0.
+        """
+        totals = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.db'):
+                continue
+            try:
+                pid = int(filename[:-3].split('_')[1])
+            except (IndexError, ValueError):
+                # Not one of ours
+                continue
+            live = _pid_running(pid)
+            try:
+                with open(os.path.join(self.directory, filename), 'rb') as f:
+                    data = f.read()
+            except IOError as e:
+                _logger.warning(u"Unable to read metrics file %s: %s", filename, e)
+                continue
+            for (key, value, _pos) in _read_values(data):
+                if not live and key.split('{')[0] in _GAUGES:
+                    continue
+                totals[key] = totals.get(key, 0.0) + value
+
+        # Responses by status code and cache hit ratios are worked out from
+        # the totals
+        responses = dict((_sample('lesson_responses_total', (('code', code),)), 0.0) for code in status_codes)
+        ratios = {}
+        for (key, value) in totals.items():
+            if key.startswith('lesson_requests_total{'):
+                code = key[key.index('code="'):-1]
+                response = 'lesson_responses_total{%s}' % (code,)
+                responses[response] = responses.get(response, 0.0) + value
+            elif key.startswith('lesson_cache_hits_total{'):
+                labels = key[key.index('{'):]
+                lookups = value + totals.get('lesson_cache_misses_total' + labels, 0.0)
+                if lookups > 0:
+                    ratios['lesson_cache_hit_ratio' + labels] = value / lookups
+                else:
+                    ratios['lesson_cache_hit_ratio' + labels] = 0.0
+        totals.update(responses)
+        totals.update(ratios)
+
+        by_metric = {}
+        for (key, value) in totals.items():
+            name = key.split('{')[0]
+            for suffix in ('_bucket', '_sum', '_count'):
+                if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+                    name = name[:-len(suffix)]
+                    break
+            by_metric.setdefault(name, []).append((key, value))
+
+        lines = []
+        for name in sorted(by_metric):
+            if name in METRICS:
+                (metric_type, metric_help) = METRICS[name]
+                lines.append('# HELP %s %s' % (name, metric_help))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+            for (key, value) in sorted(by_metric[name], key=_sort_key):
+                lines.append('%s %s' % (key, repr(float(value))))
+        return u'\n'.join(lines) + u'\n'
+
+def _sort_key(sample):
+    """
+    Sort histogram buckets by their numeric bound, with +Inf last
+    """
+    (key, _value) = sample
+    if '_bucket{' in key and 'le="' in key:
+        start = key.index('le="') + 4
+        bound = key[start:key.index('"', start)]
+        if bound == '+Inf':
+            bound = float('inf')
+        else:
+            bound = float(bound)
+        return (key[:start], bound)
+    return (key, 0)
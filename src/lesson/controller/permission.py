@@ -33,7 +33,7 @@ class Permission:
         #     return False
 
         # Admin only permissions
-        if permission in ["list_users", "show_log", "show_year", "show_departments", "show_attributes"]:
+        if permission in ["list_users", "show_log", "show_year", "show_departments", "show_attributes", "show_pool", "show_router", "show_metrics"]:
             if self.user.Permissions == 1:
                 return True
             return False
@@ -0,0 +1,146 @@
+"""
+controller.response_cache
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+import cPickle as pickle
+import hashlib
+
+from sqlalchemy import event
+from sqlalchemy.orm import object_mapper
+
+from controller.cache import Cache
+
+# Generation that every response depends on, so they can all be dropped
+_ALL = '*'
+
+def _table_names(objects):
+    names = set()
+    for obj in objects:
+        for table in object_mapper(obj).tables:
+            names.add(table.name)
+    return names
+
+class ResponseCache(object):
+    """
+    Cache of rendered responses in a cache backend.  Each response remembers
+    the generations of the tables it was built from, and is out of date as
+    soon as one of them is changed by a process using the same backend.
+    With a local backend, changes made by other processes are only picked
+    up when the response expires.  If backend is None, nothing is cached.
+    """
+
+    def __init__(self, backend=None):
+        self._cache = None
+        if backend is not None:
+            self._cache = Cache(backend, 'response')
+        self.invalidations = 0
+
+    def enabled(self):
+        return self._cache is not None
+
+    def _key(self, key):
+        return hashlib.sha1(pickle.dumps(key, pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+    def generations(self, tables):
+        """
+        Return current generations of tables.  This must be called before
+        the response is built, so changes made while it's being built make
+        it out of date.
+        """
+        return self._cache.generations(sorted(tables) + [_ALL])
+
+    def get(self, key):
+        """
+        Return tuple of (body, headers) cached for key, or None
+        """
+        # Entries from a shared backend come back as JSON, with lists for
+        # tuples and unicode for strings
+        def current(entry):
+            return list(entry[3]) == list(self.generations(entry[2]))
+
+        entry = self._cache.get(self._key(key), current)
+        if entry is None:
+            return None
+        body = entry[0]
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        return (body, [tuple(header) for header in entry[1]])
+
+    def put(self, key, body, headers, tables, generations, ttl):
+        """
+        Cache body and list of (header, value) headers for key for ttl
+        seconds, or until one of the names in tables is changed.
+        generations must come from generations(tables).
+        """
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if ttl <= 0:
+            return
+        self._cache.set(self._key(key), (body, tuple(headers), tuple(sorted(tables)), generations), ttl)
+
+    def invalidate(self, tables=None):
+        """
+        Make every response built from any of the names in tables out of
+        date, or every response if tables is None
+        """
+        if tables is None:
+            tables = [_ALL]
+        for table in tables:
+            self._cache.invalidate(table)
+            self.invalidations += 1
+
+    def watch(self, session_factory):
+        """
+        Drop responses whenever the tables they were built from are flushed
+        by a session from session_factory.  They're dropped again when the
+        session commits, in case a request cached the old rows in between.
+        """
+        if self._cache is None:
+            return
+
+        def after_flush(session, flush_context):  # @UnusedVariable
+            tables = _table_names(session.new) | _table_names(session.dirty) | _table_names(session.deleted)
+            if tables:
+                session.info.setdefault('response_cache_tables', set()).update(tables)
+                self.invalidate(tables)
+
+        def after_commit(session):
+            tables = session.info.pop('response_cache_tables', None)
+            if tables:
+                self.invalidate(tables)
+
+        event.listen(session_factory, 'after_flush', after_flush)
+        event.listen(session_factory, 'after_commit', after_commit)
+
+    def counters(self):
+        """
+        Return tuple of (hits, misses) in this process
+        """
+        if self._cache is None:
+            return (0, 0)
+        return self._cache.counters()
+
+    def stats(self):
+        """
+        Return dictionary of cache counters
+        """
+        if self._cache is None:
+            return {u'hits': 0, u'misses': 0, u'hit_ratio': 0.0, u'invalidations': 0}
+        stats = self._cache.stats()
+        stats[u'invalidations'] = self.invalidations
+        return stats
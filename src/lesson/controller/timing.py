@@ -0,0 +1,165 @@
+"""
+controller.timing
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+import ctypes, ctypes.util, os, threading, time, logging
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from controller.logger import get_logger
+
+_slow_logger = get_logger('slow')
+# Slow requests are logged whatever the overall level is, unless the 'slow'
+# logger's own level is set
+_slow_logger.setLevel(logging.WARNING)
+
+def _get_monotonic():
+    """
+    Return a monotonic clock function, using clock_gettime() if it's
+    available (Python 2 doesn't have time.monotonic()) and falling back to
+    time.time()
+    """
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+    try:
+        monotonic()
+    except OSError:
+        return time.time
+    return monotonic
+
+monotonic = _get_monotonic()
+
+_local = threading.local()
+
+class RequestTimer(object):
+    """
+    Times the phases of one request, along with the number of SQL statements
+    it runs and how long they take
+    """
+
+    def __init__(self):
+        self.start = monotonic()
+        self.end = None
+        self.phases = []
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+    @contextmanager
+    def phase(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, monotonic() - start))
+
+    def stop(self):
+        if self.end is None:
+            self.end = monotonic()
+
+    def total(self):
+        if self.end is None:
+            return monotonic() - self.start
+        return self.end - self.start
+
+    def header(self):
+        """
+        Return value for Server-Timing header, in milliseconds
+        """
+        metrics = ['%s;dur=%.1f' % (name, duration * 1000) for (name, duration) in self.phases]
+        metrics.append('db;desc="%i queries";dur=%.1f' % (self.sql_count, self.sql_time * 1000))
+        metrics.append('total;dur=%.1f' % (self.total() * 1000,))
+        return ', '.join(metrics)
+
+    def summary(self):
+        """
+        Return one line description of where the time went, in milliseconds
+        """
+        parts = ['%s=%.1f' % (name, duration * 1000) for (name, duration) in self.phases]
+        parts.append('sql=%.1f (%i queries)' % (self.sql_time * 1000, self.sql_count))
+        return '%.1fms: %s' % (self.total() * 1000, ' '.join(parts))
+
+def start():
+    """
+    Start timing a request in this thread and return its timer
+    """
+    timer = RequestTimer()
+    _local.timer = timer
+    return timer
+
+def current():
+    """
+    Return timer for the request being handled in this thread, or None
+    """
+    return getattr(_local, 'timer', None)
+
+def finish(timer, description, threshold):
+    """
+    Stop timer and write it to the slow request log if it took longer than
+    threshold seconds.  A threshold of 0 or None never logs.
+    """
+    timer.stop()
+    if getattr(_local, 'timer', None) is timer:
+        _local.timer = None
+    if threshold and timer.total() > threshold:
+        _slow_logger.warning(u"%s took %s", description, timer.summary())
+
+def configure_slow_log(path):
+    """
+    Write the slow request log to its own file rather than the main log
+    """
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    _slow_logger.addHandler(handler)
+    _slow_logger.propagate = False
+
+def watch_engine(engine):
+    """
+    Count SQL statements run by engine and their time against the request
+    being handled in the thread that runs them
+    """
+    def before_execute(conn, cursor, statement, parameters, context, executemany):  # @UnusedVariable
+        if getattr(_local, 'timer', None) is not None:
+            conn.info['timing_start'] = monotonic()
+
+    def after_execute(conn, cursor, statement, parameters, context, executemany):  # @UnusedVariable
+        timer = getattr(_local, 'timer', None)
+        start = conn.info.pop('timing_start', None)
+        if timer is None or start is None:
+            return
+        timer.sql_count += 1
+        timer.sql_time += monotonic() - start
+
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    event.listen(engine, 'after_cursor_execute', after_execute)
@@ -25,13 +25,16 @@ if abspath not in sys.path:
 os.chdir(abspath)
 
 import render
+from controller.logger import get_logger
+
+_logger = get_logger('main')
 
 mode = "debug"
 
 if __name__.startswith('_mod_wsgi_'):
-    print "Detected mod_wsgi; running in WSGI mode"
+    _logger.info("Detected mod_wsgi; running in WSGI mode")
     mode = "wsgi"
 else:
-    print "Running in debug mode"
+    _logger.info("Running in debug mode")
 
 application = render.start(mode)
@@ -0,0 +1,110 @@
+"""
+manifest
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+# The route manifest lists the url patterns of every view class, so a new
+# process can fill in its routes without importing the view modules.  The
+# router is given 'module.Class' strings, which web.py only imports the
+# first time one of their urls is requested.  Modules that define database
+# tables still have to be imported at startup, as their pages are generated
+# from the tables, so they're listed separately.
+#
+# The manifest is written the first time the backend starts without one.
+# It also lists the modification time and size of every file in the view
+# package, and is rebuilt when they don't match, so adding or changing a
+# view takes effect on the next start.  scripts/build_manifest.py rebuilds
+# it by hand.
+
+import json, os, tempfile
+
+from controller.logger import get_logger
+
+_logger = get_logger(__name__)
+
+# Manifests in any other format are ignored
+FORMAT = 2
+
+def view_files(directory):
+    """
+    Return dictionary of [modification time, size] for every Python file in
+    package directory and its subpackages, keyed on path relative to
+    directory.  These are the files recursive_import() would import.
+    """
+    files = {}
+    for (path, dirs, filenames) in os.walk(directory):
+        # Only walk into packages
+        dirs[:] = [name for name in dirs if os.path.exists(os.path.join(path, name, '__init__.py'))]
+        for filename in filenames:
+            if not filename.endswith('.py'):
+                continue
+            full_path = os.path.join(path, filename)
+            stat = os.stat(full_path)
+            files[os.path.relpath(full_path, directory)] = [stat.st_mtime, stat.st_size]
+    return files
+
+def build(url_dict, modules, eager, files):
+    """
+    Return manifest for the routes in url_dict that are served by classes in
+    modules.  eager is the modules that have to be imported at startup, and
+    files is view_files() for the view package.
+    """
+    routes = []
+    for (pattern, (priority, target, absolute)) in url_dict.items():
+        if target.rsplit('.', 1)[0] in modules:
+            routes.append([pattern, priority, target, absolute])
+    routes.sort()
+    return {u'format': FORMAT, u'routes': routes, u'eager': sorted(eager), u'files': files}
+
+def load(path, files):
+    """
+    Return manifest from path, or None if it's missing, can't be used or
+    was built from view files other than files
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except IOError:
+        return None
+    except ValueError:
+        _logger.warning(u"Ignoring invalid route manifest '%s'", path)
+        return None
+    if not isinstance(manifest, dict) or manifest.get(u'format') != FORMAT:
+        _logger.warning(u"Ignoring route manifest '%s' in unknown format", path)
+        return None
+    if manifest.get(u'files') != files:
+        _logger.info(u"Route manifest '%s' is out of date", path)
+        return None
+    return manifest
+
+def write(path, manifest):
+    """
+    Write manifest to path.  It's written to a temporary file that's then
+    renamed, so other processes starting at the same time never read half
+    of it.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    (fd, temp_path) = tempfile.mkstemp(prefix='.manifest', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(manifest, f, indent=1, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
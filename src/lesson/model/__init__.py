@@ -17,12 +17,19 @@ Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 Copyright (C) 2012 Jonathan Dieter <jdieter@lesbg.com>
 """
 
-from sqlalchemy import create_engine
+import threading
+
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.orm import sessionmaker, object_mapper
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, Unicode
 
+from controller import timing
+from controller.logger import get_logger
+
+_logger = get_logger(__name__)
+
 Base = declarative_base()
 
 class Permission(Base):
@@ -33,12 +40,115 @@ class Permission(Base):
     Type = Column(Unicode(50), nullable=False, index=True)
     Username = Column(Unicode(50), nullable=False, index=True)
     
+class PoolStats(object):
+    """
+    Keeps count of how long checking a connection out of an engine's pool
+    takes, including any time spent waiting for a free connection
+
+    Checkouts are counted by pool events on the engine, which carry over to
+    the new pool when the engine is disposed.  SQLAlchemy has no event for
+    the start of a checkout, so the pool's connect() is wrapped to note when
+    it was called, and wrapped again whenever the engine gets a new pool.
+    """
+
+    # Upper bounds of checkout latency histogram buckets, in seconds
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.checkouts = 0
+        self.checked_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.histogram = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        event.listen(engine, 'checkout', self.__checkout)
+        event.listen(engine, 'checkin', self.__checkin)
+        event.listen(engine, 'engine_disposed', self.__wrap_pool)
+        self.__wrap_pool(engine)
+
+    def __wrap_pool(self, engine):
+        # Sessions check connections out with connect(), while
+        # Engine.connect() uses unique_connection() on older SQLAlchemy
+        for name in ('connect', 'unique_connection'):
+            if hasattr(engine.pool, name):
+                setattr(engine.pool, name, self.__timed(getattr(engine.pool, name)))
+
+    def __timed(self, checkout):
+        def timed_checkout():
+            self._local.start = timing.monotonic()
+            try:
+                return checkout()
+            finally:
+                self._local.start = None
+        return timed_checkout
+
+    def __checkout(self, dbapi_connection, connection_record, connection_proxy):  # @UnusedVariable
+        start = getattr(self._local, 'start', None)
+        wait = 0.0
+        if start is not None:
+            wait = timing.monotonic() - start
+            # Only the outermost checkout in a connect() is timed
+            self._local.start = None
+        self.record(wait)
+
+    def __checkin(self, dbapi_connection, connection_record):  # @UnusedVariable
+        with self._lock:
+            self.checked_out -= 1
+
+    def record(self, wait):
+        bucket = 0
+        while bucket < len(self.buckets) and wait > self.buckets[bucket]:
+            bucket += 1
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+            self.histogram[bucket] += 1
+
+    def stats(self):
+        """
+        Return dictionary of pool usage.  Pool size and overflow are None if
+        the pool type doesn't keep track of them.
+        """
+        pool = self.engine.pool
+        retval = {}
+        for (name, method) in ((u'size', 'size'), (u'overflow', 'overflow')):
+            if hasattr(pool, method):
+                retval[name] = getattr(pool, method)()
+            else:
+                retval[name] = None
+        with self._lock:
+            retval[u'checked_out'] = self.checked_out
+            retval[u'checkouts'] = self.checkouts
+            retval[u'wait_total'] = self.wait_total
+            retval[u'wait_max'] = self.wait_max
+            histogram = []
+            count = 0
+            for bucket, value in zip(self.buckets + (None,), self.histogram):
+                count += value
+                histogram.append((bucket, count))
+            retval[u'histogram'] = histogram
+        return retval
+
 class Session(object):
     def __init__(self, engine, **engine_opts):
         self.engine = create_engine(engine, **engine_opts)
         self.create_session = sessionmaker(bind=self.engine)
+        self.pool_stats = PoolStats(self.engine)
 
 class TableTop(object):
+    # Large tables set this to True so their list pages are paged by primary
+    # key rather than by offset
+    Keyset = False
+    # Tables that rarely change set this to the number of seconds their
+    # automatically generated pages may be served from the response cache
+    CacheTTL = None
+
     def _get_list_link(self):
         if not hasattr(self, "Link"):
             return None
@@ -47,7 +157,17 @@ class TableTop(object):
     def _get_obj_link(self):
         if self.get_list_link() is None:
             return None
-        return u"%s/%s" % (self.Link, unicode(self.get_primary_key()[1]))
+        return self.get_obj_link_from_key(self.get_primary_key()[1])
+
+    @classmethod
+    def get_obj_link_from_key(cls, key):
+        """
+        Return object link for primary key value key without needing to load
+        the object
+        """
+        if not hasattr(cls, "Link"):
+            return None
+        return u"%s/%s" % (cls.Link, unicode(key))
 
     def _get_attr_link(self):
         if self.get_obj_link() is None:
@@ -83,7 +203,7 @@ class TableTop(object):
                 obj = local_list[name]
             except:
                 raise NameError("Variable '%s' doesn't exist" % (name,))
-            print name, obj, check_type
+            _logger.debug("%s %r %s", name, obj, check_type)
             if not isinstance(obj, check_type):
                 if allow_none:
                     if obj is None:
@@ -95,4 +215,34 @@ class TableTop(object):
                     
             
     def has_permission(self, user):
-        pass
\ No newline at end of file
+        pass
+
+
+_link_registry = {}
+
+def _register_link(mapper, cls):  # @UnusedVariable
+    """
+    Add table class to the link registry when it is mapped.  Two tables with
+    the same Link would make filter urls ambiguous, so refuse to start.
+    """
+    if not hasattr(cls, 'Link'):
+        return
+    old_cls = _link_registry.get(cls.Link)
+    if old_cls is not None and old_cls is not cls:
+        raise ValueError("Table classes %s.%s and %s.%s both have Link '%s'" % (old_cls.__module__, old_cls.__name__, cls.__module__, cls.__name__, cls.Link))
+    _link_registry[cls.Link] = cls
+
+event.listen(TableTop, 'instrument_class', _register_link, propagate=True)
+
+def get_table(link):
+    """
+    Return table class whose Link is link, or None if there isn't one
+    """
+    return _link_registry.get(link)
+
+def get_link(entity):
+    """
+    Return Link of a table class or an aliased table class, or None if it
+    doesn't have one
+    """
+    return getattr(inspect(entity).mapper.class_, 'Link', None)
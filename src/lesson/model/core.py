@@ -101,6 +101,7 @@ class Year(Base, TableTop):
     YearName = Column('Year', Unicode(50), nullable=False)
 
     Link = "years"
+    CacheTTL = 300
 
     def __repr__(self):
         return u"<Year('%s')>" % (self.YearName)
@@ -127,6 +128,7 @@ class Department(Base, TableTop):
     DepartmentName = Column('Department', Unicode(50), nullable=False)
 
     Link = "departments"
+    CacheTTL = 300
 
     def __repr__(self):
         return u"<Department('%s')>" % (self.DepartmentName)
@@ -155,6 +157,7 @@ class SubjectType(Base, TableTop):
     HighPriority = Column(Integer, nullable=False, default=0)  # boolean
 
     Link = "SubjectTypes"
+    CacheTTL = 300
 
     def __repr__(self):
         return u"<SubjectType('%s')>" % (self.Title)
@@ -259,6 +262,7 @@ class NonmarkType(Base, TableTop):
     DepartmentObject = relationship(Department, primaryjoin=DepartmentIndex == Department.DepartmentIndex, foreign_keys=[Department.DepartmentIndex], uselist=False)
 
     Link = 'nonmark_types'
+    CacheTTL = 300
 
     def __repr__(self):
         return u"<NonmarkType('%s')>" % (self.NonmarkTypeName)
@@ -773,6 +777,7 @@ class Casenote(Base, TableTop):
     StudentObject = relationship(User, primaryjoin=StudentUsername == User.Username, foreign_keys=[User.Username], uselist=False)
 
     Link = "casenotes"
+    Keyset = True
 
     def __repr__(self):
         return u"<Casenote('%s -> %s (%s)')>" % (self.StaffUsername, self.StudentUsername, self.Date)
@@ -807,6 +812,7 @@ class Log(Base, TableTop):
     UserObject = relationship(User, primaryjoin=Username == User.Username, foreign_keys=[User.Username], backref=backref('Logs', uselist=True), uselist=False)
 
     Link = "logs"
+    Keyset = True
 
     def __repr__(self):
         return u"<Log('%i - %s - %s')>" % (self.Level, self.Username, self.Comment)
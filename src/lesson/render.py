@@ -20,14 +20,25 @@ from sqlalchemy.sql.schema import Column
 
 uuid = u'7bb2302a-a003-11e1-9b06-00163e9a5f9b'
 
-import web, re, base64, os.path
+# Startup phases are timed with controller.timing, which isn't loaded yet
+import time
+_imports_start = time.time()
+
+import web, re, base64, os.path, urllib, logging, datetime
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
 import mimerender
 import sqlalchemy.orm
-from sqlalchemy.orm import class_mapper, object_mapper, aliased
+from sqlalchemy.orm import class_mapper, aliased
+from sqlalchemy.sql import exists, tuple_
 
-from render_commands import RenderCom
+from render_commands import RenderCom, StreamList
+from router import Router
 import model
-from controller import password
+from controller import auth
 from controller.permission import Permission
 
 import controller.core_version  # @UnusedImport
@@ -36,22 +47,37 @@ from controller import log
 
 import sys
 
-from version import VersionCheck
+import version
 
-from model.core import User
+from model.core import User, LogIgnoreHost
 
 from error import *
 
 from controller import config
+from controller import logger, timing, metrics, conditional, response_cache, cache
 
 from recursive_import import recursive_import
+import manifest
+
+_logger = logger.get_logger(__name__)
 
 mimerender = mimerender.WebPyMimeRender()
 
 url_dict = {}
 urls = []
+# Seconds taken by each phase of startup, in order (see _startup_phase)
+startup_times = [('imports', time.time() - _imports_start)]
+
+def _startup_phase(name, function, *args):
+    """
+    Run function as startup phase name, recording how long it takes
+    """
+    start = timing.monotonic()
+    try:
+        return function(*args)
+    finally:
+        startup_times.append((name, timing.monotonic() - start))
 
-DEBUG = True
 
 class _GlobalData(object):
     def __init__(self):
@@ -59,13 +85,127 @@ class _GlobalData(object):
         # self.store = None
         self.rendercom = None
         self.config = config.get_file_config()
+        logger.configure(self.config)
         self.engine = unicode(self.config.get('Main', 'database'))
         self.script_dir = self.config.get('Main', 'script dir')
-        self.db = model.Session(self.engine, pool_recycle=3600)
-        self.log = log.Log(self.db)
+        self.route_manifest = config.get_file_option(self.config, 'Main', 'route manifest', u'view/manifest.json')
+        if self.route_manifest:
+            self.route_manifest = os.path.join(os.path.dirname(os.path.abspath(__file__)), self.route_manifest)
+        self.version_stamp = config.get_file_option(self.config, 'Main', 'version stamp', u'config/version.stamp')
+        self.db = model.Session(self.engine, **config.get_database_options(self.config))
+        timing.watch_engine(self.db.engine)
+        self.server_timing = config.get_file_option(self.config, 'Timing', 'server timing', False, config.boolean)
+        self.slow_request_threshold = config.get_file_option(self.config, 'Timing', 'slow request threshold', 1.0, float)
+        slow_request_file = config.get_file_option(self.config, 'Timing', 'slow request file')
+        if slow_request_file:
+            timing.configure_slow_log(slow_request_file)
+        # With a shared backend, the config and response caches are shared
+        # with every other process, otherwise each cache keeps its own
+        # entries.  Caches holding password hashes are always local.
+        self.cache_backend = cache.create_backend(self.config)
+        shared_backend = None
+        shared_config = None
+        if self.cache_backend.shared:
+            shared_backend = self.cache_backend
+            shared_config = cache.Cache(shared_backend, 'config')
+        config.configure_cache(config.get_file_option(self.config, 'Cache', 'config ttl', 60, int), shared_config)
+        response_size = config.get_file_option(self.config, 'Cache', 'response cache size', 8 * 1024 * 1024, int)
+        response_backend = None
+        if response_size > 0:
+            response_backend = shared_backend or cache.create_backend(self.config, size=response_size)
+        self.response_cache = response_cache.ResponseCache(response_backend)
+        self.response_cache.watch(self.db.create_session)
+        ignore_hosts = log.IgnoreHostCache(self.db,
+            config.get_file_option(self.config, 'Log', 'ignore host ttl', 60, int))
+        ignore_hosts.watch(LogIgnoreHost)
+        self.log = log.Log(self.db, self.__log_writer(), ignore_hosts)
+        self.auth_cache = auth.CredentialCache(
+            config.get_file_option(self.config, 'Auth', 'credential cache size', 1024, int),
+            config.get_file_option(self.config, 'Auth', 'credential cache ttl', 300, int))
+        self.auth_cache.watch(User)
+        self.user_cache = auth.UserCache(self.db, User,
+            ttl=config.get_file_option(self.config, 'Auth', 'user cache ttl', 60, int))
+        self.user_cache.watch(User)
+        self.token_lifetime = config.get_file_option(self.config, 'Auth', 'token lifetime', 3600, int)
+        self.metrics = metrics.Metrics(config.get_file_option(self.config, 'Metrics', 'directory'))
+        self.metrics_interval = config.get_file_option(self.config, 'Metrics', 'update interval', 5.0, float)
+        # None if bearer tokens are disabled
+        self.token_signer = None
+        token_secret = auth.get_token_secret(self.config)
+        if token_secret:
+            self.token_signer = auth.TokenSigner(token_secret, self.token_lifetime)
+
+    def __log_writer(self):
+        """
+        Create background log writer, or return None if 'queue size' is 0, in
+        which case log entries are written while the page is being served
+        """
+        queue_size = config.get_file_option(self.config, 'Log', 'queue size', 10000, int)
+        if queue_size <= 0:
+            return None
+        return log.LogWriter(self.db, queue_size,
+            config.get_file_option(self.config, 'Log', 'batch size', 100, int),
+            config.get_file_option(self.config, 'Log', 'flush interval', 1.0, float),
+            config.get_file_option(self.config, 'Log', 'overflow', log.BLOCK),
+            config.get_file_option(self.config, 'Log', 'spill file') or None)
+
+    def update_metrics(self, interval=0):
+        """
+        Write this process's pool, log queue and cache statistics for the
+        metrics page, at most once every interval seconds
+        """
+        if not self.metrics.due(interval):
+            return
+        samples = []
+        pool = self.db.pool_stats.stats()
+        for name in (u'size', u'checked_out', u'overflow'):
+            samples.append(('lesson_db_pool_' + name, None, pool[name]))
+        for (bucket, count) in pool[u'histogram']:
+            if bucket is None:
+                bucket = '+Inf'
+            samples.append(('lesson_db_pool_checkout_seconds_bucket', (('le', bucket),), count))
+        samples.append(('lesson_db_pool_checkout_seconds_sum', None, pool[u'wait_total']))
+        samples.append(('lesson_db_pool_checkout_seconds_count', None, pool[u'checkouts']))
+
+        if self.log.writer is not None:
+            samples.append(('lesson_log_queue_depth', None, self.log.writer.depth()))
+
+        for (phase, seconds) in startup_times:
+            samples.append(('lesson_startup_seconds', ((u'phase', phase),), seconds))
+
+        for (name, cache) in ((u'auth', self.auth_cache), (u'user', self.user_cache), (u'config', config.cache),
+                              (u'response', self.response_cache)):
+            # Only this process's counters, as a shared backend's stats()
+            # is a round trip to every memcached server
+            (hits, misses) = cache.counters()
+            samples.append(('lesson_cache_hits_total', ((u'cache', name),), hits))
+            samples.append(('lesson_cache_misses_total', ((u'cache', name),), misses))
+
+        self.metrics.update_process(samples, interval)
+
+    def record_request(self, page, status, duration):
+        """
+        Count request to page for the metrics page.  A status of None means
+        the page raised an exception.
+        """
+        if status is None:
+            code = u'500'
+        else:
+            code = unicode(status).split(' ', 1)[0]
+        route = u'%s.%s' % (page.__class__.__module__, page.__class__.__name__)
+        self.metrics.observe_request(route, code, duration)
+        self.update_metrics(self.metrics_interval)
+
+    def collect_metrics(self):
+        """
+        Return metrics for every backend process in text exposition format
+        """
+        self.update_metrics()
+        return self.metrics.collect([u'200'] + [unicode(code) for code in sorted(web_error)])
 
-_global_data = _GlobalData()
+_global_data = _startup_phase('globals', _GlobalData)
 _global_data.rendercom = RenderCom()
+_global_data.router = None
 
 def _append_url(string, priority, module, name, absolute):
     if not hasattr(string, 'strip'):
@@ -74,9 +214,8 @@ def _append_url(string, priority, module, name, absolute):
         if url_dict.has_key(string):
             if url_dict[string][0] <= priority:
                 return
-            if DEBUG:
-                print 'Replacing class for location %s' % (string,)
-                print '  %s -> %s.%s' % (url_dict[string][1], module, name)
+            _logger.debug('Replacing class for location %s: %s -> %s.%s',
+                          string, url_dict[string][1], module, name)
 
     url_dict[string] = (priority, '%s.%s' % (module, name), absolute)
     return
@@ -90,6 +229,9 @@ def _is_listish(obj):
         return False
 
 def _die_on_string(obj):
+    # Streamed lists can only be read once, while they're being sent
+    if isinstance(obj, StreamList):
+        return
     if(_is_listish(obj)):
         if hasattr(obj, 'values'):
             for item in obj.values():
@@ -104,17 +246,57 @@ def _die_on_string(obj):
         if isinstance(obj, str):
             raise ValueError('All strings must be unicode strings')
 
+# Key in the WSGI environment for the function that closes the streamed list
+# being sent in the response
+_STREAM_CLOSE_KEY = 'lesson.stream_close'
+
+class _ClosingResponse(object):
+    """
+    WSGI response that calls on_close when the server closes it.  web.py's
+    own response has no close(), so a streamed list would otherwise keep its
+    database session until it's garbage collected if the client disconnects
+    before the whole list is sent.
+    """
+
+    def __init__(self, response, on_close):
+        self.response = response
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def close(self):
+        try:
+            if hasattr(self.response, 'close'):
+                self.response.close()
+        finally:
+            self.on_close()
+
+def _close_streams(application):
+    """
+    WSGI middleware that closes streamed lists when the server is done with
+    the response, however it finishes
+    """
+    def wsgi(environ, start_response):
+        response = application(environ, start_response)
+        on_close = environ.pop(_STREAM_CLOSE_KEY, None)
+        if on_close is None:
+            return response
+        return _ClosingResponse(response, on_close)
+    return wsgi
+
 def start(mode):
-    print "Starting in %s mode" % mode
+    _logger.info("Starting in %s mode", mode)
     
-    app = web.application(urls, globals())
+    app = Router(urls, globals())
+    _global_data.router = app
     if mode == "debug":
-        app.run()
+        app.run(_close_streams)
     elif mode == "wsgi":
-        application = app.wsgifunc()
+        application = app.wsgifunc(_close_streams)
         return application
     else:
-        print "ERROR: Unknown mode: %s" % (mode,)
+        _logger.error("Unknown mode: %s", mode)
         sys.exit(1)
 
 class _ActionMetaClass(type):
@@ -144,6 +326,12 @@ class _ActionMetaClass(type):
                         _append_url(item, priority, klass.__module__, name, absolute)
             else:
                 _append_url(obj, priority, klass.__module__, name, absolute)
+            # Views listed in the route manifest are imported after startup,
+            # so they never go through __fill_uuid
+            if not getattr(klass, 'uuid', None):
+                module_uuid = getattr(sys.modules.get(klass.__module__), 'uuid', None)
+                if module_uuid:
+                    klass.uuid = module_uuid
 
 class Page:
 
@@ -165,12 +353,49 @@ class Page:
     log_error = True
     log_level = log.INFO
     status = None
-    session = None
+    _session = None
+    # Set when the response streams from the database session, so the
+    # session is closed by the stream rather than at the end of _parse
+    _streaming = False
+    # Times the phases of the request (see controller.timing)
+    timer = None
     uuid = None
+    auth_method = None
+    # Send ETag headers and answer conditional GETs with 304 Not Modified.
+    # Pages whose payloads change on every request can turn this off.
+    conditional = True
+    # Serve GETs from the response cache for up to table.CacheTTL seconds.
+    # Only the automatically generated table pages set this, as their
+    # responses only depend on the tables in _response_tables().
+    cache_response = False
+
+    def __get_session(self):
+        """
+        Open the database session for this request the first time it's used
+        """
+        if self._session is None:
+            self._session = self.db.create_session()
+        return self._session
+
+    def __set_session(self, session):
+        self._session = session
+
+    session = property(__get_session, __set_session)
+
+    def _close_session(self):
+        """
+        Close the database session for this request if it was opened
+        """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     def __init__(self):
         self.db = _global_data.db
         self._log = _global_data.log
+        self._auth_cache = _global_data.auth_cache
+        self._user_cache = _global_data.user_cache
+        self.router = _global_data.router
 
     def log(self, comment, level=None, user=None):
         if user is None:
@@ -186,11 +411,20 @@ class Page:
             record_level = self.record_log_level
         self._log.log(web.ctx, web.ctx.fullpath.replace("/" + self.prefix + "/", ""), user, level, comment, record_level)
 
+    def get_metrics(self):
+        """
+        Return metrics for every backend process in text exposition format
+        """
+        return _global_data.collect_metrics()
+
     def get_config(self, key, fallback=True):
         """
         Return config value of 'key'.  If config value doesn't exist, return
         None.
         """
+        (cached, value) = config.get_cached_config(self.uuid, key, fallback)
+        if cached:
+            return value
         return config.get_config(self.session, self.uuid, key, fallback)
 
     def set_config(self, key, value):
@@ -228,22 +462,131 @@ class Page:
         else:
             raise ValueError('Too many arguments.  This should be impossible')
 
+    def _not_modified(self, result):
+        """
+        Set ETag header for result and return True if the client already has
+        it, in which case the response is 304 Not Modified and result doesn't
+        need to be rendered
+        """
+        if not self.conditional or web.ctx.method != 'GET' or self.errno is not None:
+            return False
+        if not unicode(self.status).startswith('200') or not web.ctx.status.startswith('200'):
+            return False
+
+        # mimerender picks the format from these, so each gets its own ETag
+        variant = (web.input(_method='get').get('format'), web.ctx.env.get('HTTP_ACCEPT'))
+        etag = conditional.etag(result, variant, _global_data.rendercom.json_handler)
+        if etag is None:
+            return False
+
+        web.header('ETag', etag)
+        web.header('Vary', 'Accept, Authorization')
+        web.header('Cache-Control', 'private, no-cache')
+        if not conditional.not_modified(web.ctx.env, etag):
+            return False
+        self.status = '304 Not Modified'
+        return True
+
+    def _response_cache_ttl(self):
+        """
+        Return number of seconds this request's response may be cached for,
+        or 0 if it mustn't be
+        """
+        if not self.cache_response or self.table is None or web.ctx.method != 'GET':
+            return 0
+        if not _global_data.response_cache.enabled():
+            return 0
+        return self.table.CacheTTL or 0
+
+    def _response_cache_key(self):
+        return (self.__class__.__name__, self.prefix, web.ctx.home, web.ctx.query, web.ctx.env.get('HTTP_ACCEPT'))
+
+    def _response_tables(self):
+        """
+        Return names of the tables this page's response was built from
+        """
+        tables = set([class_mapper(self.table).local_table.name])
+        for ffilter in self.filters:
+            tables.add(class_mapper(model.get_table(ffilter['table'])).local_table.name)
+        return tables
+
+    def _cached_response(self):
+        """
+        Return cached response body for this request and set its headers, or
+        return None if it isn't cached.  This must only be called once the
+        user's permissions have been checked.
+        """
+        cached = _global_data.response_cache.get(self._response_cache_key())
+        if cached is None:
+            return None
+
+        (body, headers) = cached
+        etag = None
+        for (name, value) in headers:
+            web.header(name, value)
+            if name == 'ETag':
+                etag = value
+        if etag is not None and conditional.not_modified(web.ctx.env, etag):
+            self.status = '304 Not Modified'
+            return ''
+        return body
+
+    def issue_token(self):
+        """
+        Return tuple of (bearer token, expiry time) for the logged in user, or
+        None if bearer tokens are disabled
+        """
+        if _global_data.token_signer is None:
+            return None
+        return _global_data.token_signer.issue(self.user)
+
+    def _logged_token(self, token):
+        """
+        Log in using a bearer token issued by issue_token().  This only needs
+        an HMAC check and a cached user lookup, so no password hashing is done
+        """
+        signer = _global_data.token_signer
+        if signer is None:
+            self.log(u"Bearer tokens are disabled", log.ERROR, u"")
+            return False
+        parsed_token = signer.parse(token)
+        if parsed_token is None:
+            self.log(u"Invalid or expired token", log.ERROR, u"")
+            return False
+        username = parsed_token[0]
+        user = self._user_cache.get(self.session, username)
+        if user is None:
+            self.log(u"Non-existent username in token: %s" % (username,), log.ERROR, unicode(username))
+            return False
+        if not signer.check(parsed_token, user.Password):
+            self.log(u"Invalid token for username: %s" % (username,), log.ERROR, unicode(username))
+            return False
+        self.user = user
+        self.validator = Permission(user)
+        self.auth_method = u'token'
+
+        return True
+
     def logged(self):
         auth = web.ctx.env.get('HTTP_AUTHORIZATION')  # @UndefinedVariable
         if auth is None:
             return False
+        elif auth.startswith('Bearer '):
+            return self._logged_token(auth[7:].strip())
         else:
             auth = re.sub('^Basic ', '', auth)
-            username, passwd = base64.decodestring(auth).split(':')
+            username, passwd = base64.decodestring(auth).split(':', 1)
             user = self.session.query(User).filter_by(Username=username).first()
             if user is None:
+                self._auth_cache.invalidate(username)
                 self.log(u"Non-existent username: %s" % (username,), log.ERROR, unicode(username))
                 return False
-            if not password.validate(passwd, user.Password):
+            if not self._auth_cache.validate(username, passwd, user.Password):
                 self.log(u"Invalid password for username: %s" % (username,), log.ERROR, unicode(username))
                 return False
             self.user = user
             self.validator = Permission(user)
+            self.auth_method = u'basic'
 
             return True
 
@@ -259,6 +602,8 @@ class Page:
     def check_permissions(self):
         if not self.logged():
             web.header('WWW-Authenticate', 'Basic realm="LESSON login"')
+            if _global_data.token_signer is not None:
+                web.header('WWW-Authenticate', 'Bearer realm="LESSON login"')
             self.errno = UNAUTHORIZED
             self.error = u"You must log in before accessing this page"
             self.log_error = False
@@ -348,10 +693,10 @@ class Page:
                 # Extract link table and key from link section
                 (table, link_table, key) = self.__split_url_segment(item)
 
-                for x in model.TableTop.__subclasses__():  # @UndefinedVariable
-                    if hasattr(x, "Link") and x.Link == table:
-                        self.filters.append({'table_class': x, 'table': table, 'link_table': link_table, 'key': key})
-                        step = 2
+                x = model.get_table(table)
+                if x is not None:
+                    self.filters.append({'table_class': x, 'table': table, 'link_table': link_table, 'key': key})
+                    step = 2
                 if step != 2:  # We didn't find any tables that matched
                     self.errno = 400
                     self.error = u"Table %s isn't in database" % (table,)
@@ -374,16 +719,15 @@ class Page:
             self.query = None
             return
 
-        print self.filters
+        _logger.debug("Filters: %s", self.filters)
         self.filters.reverse()
         query = self.session.query(self.table)
 
         used_table_list = [(class_mapper(self.table), self.table)]
         for item in self.filters:
-            if item['link_table'] is not None and hasattr(used_table_list[0][1], "Link") and item['link_table'] == used_table_list[0][1].Link:
+            if item['link_table'] is not None and item['link_table'] == model.get_link(used_table_list[0][1]):
                 item['link_table'] = None
 
-            foreign_key = None
             table = class_mapper(item['table_class'])
 
             # Get linked table in relationship and store in link_table
@@ -394,7 +738,7 @@ class Page:
             else:
                 found = False
                 for test_table in used_table_list:
-                    if test_table[1].Link == item['link_table']:
+                    if model.get_link(test_table[1]) == item['link_table']:
                         link_table_class = test_table[1]
                         link_table = test_table[0]
                         found = True
@@ -413,37 +757,19 @@ class Page:
             used_table_list.insert(0, (table, item['table_class']))
             
             # Get primary key in relationship
-            count = 0
-            for x in link_table.iterate_properties:
-                if isinstance(x, sqlalchemy.orm.properties.RelationshipProperty): # @UndefinedVariable
-                    for key, value in x.__dict__.items():
-                        print("{: <11}".format(key), " --> ", value)
-                    remote = None
-                    local = None
-                    # Deal with sqlachemy changes
-                    if hasattr(x, 'local_remote_pairs'): # sqlachemy 0.9+
-                        local = x.local_remote_pairs[0][0]
-                        remote = x.local_remote_pairs[0][1]
-                    else:                                # sqlalchemy < 0.9
-                        remote = x.remote_side[0]
-                        local = x.local_side[0]
-                    if remote == table.primary_key[0]:
-                        count += 1
-                        if item['key'] is not None:
-                            if item['key'] == unicode(local.key):
-                                foreign_key = getattr(link_table_class, local.key)
-                                if item['key'] == unicode(remote.key):
-                                    item['key'] = None
-                        else:  # No specified key
-                            foreign_key = getattr(link_table_class, local.key)
-                            if count > 1:  # More than one possible relationship, so don't return any
-                                self.errno = 400
-                                self.error = "There are multiple possible relationships between column %s in table %s and table %s" % (table.primary_key[0].key, item['table_class'].Link, link_table_class.Link)
-                                return
-            if foreign_key is None:
+            join_columns = _relationship_graph.get((table.class_, link_table.class_, item['key']), ())
+            if item['key'] is None and len(join_columns) > 1:  # More than one possible relationship, so don't return any
+                self.errno = 400
+                self.error = "There are multiple possible relationships between column %s in table %s and table %s" % (table.primary_key[0].key, item['table_class'].Link, link_table_class.Link)
+                return
+            if len(join_columns) == 0:
                 self.errno = 400
                 self.error = "There's no relationship between column %s in table %s and table %s" % (table.primary_key[0].key, item['table_class'].Link, link_table_class.Link)
                 return
+            (local_key, remote_key) = join_columns[0]
+            foreign_key = getattr(link_table_class, local_key)
+            if item['key'] is not None and item['key'] == remote_key:
+                item['key'] = None
 
             primary_key = getattr(item['table_class'], table.primary_key[0].key)
             query = query.join(item['table_class'], primary_key == foreign_key).filter(primary_key == item['value'])
@@ -455,7 +781,7 @@ class Page:
         if self.prefix != filter_url:
             full_path = web.ctx.path[1:]
             full_path = full_path.replace(self.prefix, '')
-            print 'Redirecting to /' + filter_url + full_path
+            _logger.debug('Redirecting to /%s%s', filter_url, full_path)
             web.seeother('/' + filter_url + full_path)
 
         self.query = query
@@ -472,23 +798,56 @@ class Page:
         return retval
 
     def _parse(self, procedure, args, kwargs):
-        # Open database session
-        self.session = self.db.create_session()
-
+        self.timer = timing.start()
+        status = None
+        finished = False
+        # The database session is opened when it's first needed, and must be
+        # returned to the pool however we leave
+        try:
+            retval = self.__parse(procedure, args, kwargs)
+            self.timer.stop()
+            if _global_data.server_timing:
+                web.header('Server-Timing', self.timer.header())
+            status = self.status
+            finished = True
+            return retval
+        finally:
+            # A streamed response closes the session once it has been sent,
+            # but if building it failed, it will never be sent
+            if not self._streaming or not finished:
+                self._close_session()
+            timing.finish(self.timer, u"%s %s" % (web.ctx.method, web.ctx.fullpath),
+                          _global_data.slow_request_threshold)
+            _global_data.record_request(self, status, self.timer.total())
+
+    def __parse(self, procedure, args, kwargs):
         # Get DEBUG level
-        self.record_log_level = self.get_config(u'log_level')
+        with self.timer.phase('config'):
+            self.record_log_level = self.get_config(u'log_level')
         if self.record_log_level is not None:
             self.record_log_level = int(self.record_log_level)
 
         (args, kwargs) = self._strip_prefix(args, kwargs)
 
         # Check permissions
-        self.check_permissions()
+        with self.timer.phase('auth'):
+            self.check_permissions()
 
         # Immediately exit if we've hit a permissions error
         if self.errno is not None:
             return self._render()
 
+        # Cached responses can only be sent once permissions are checked
+        cache_ttl = self._response_cache_ttl()
+        if cache_ttl:
+            with self.timer.phase('cache'):
+                retval = self._cached_response()
+            if retval is not None:
+                with self.timer.phase('log'):
+                    self.log("Accessed page")
+                return retval
+        header_count = len(web.ctx.headers)
+
         # Verify that prefix is in multiples of two
         if len(self.prefix.split('/')) % 2 != 0 and self.prefix != '':
             self.errno = 400
@@ -496,20 +855,38 @@ class Page:
             return self._render()
 
         # Verify that prefix is a valid filter
-        self._get_filters()
+        with self.timer.phase('filters'):
+            self._get_filters()
         if self.errno is not None:
             return self._render()
 
         # Generate default query
-        self._gen_default_query()
+        with self.timer.phase('query'):
+            self._gen_default_query()
         if self.errno is not None:
             return self._render()
 
-        retval = self._render(procedure(*args, **kwargs))
-        self.log("Accessed page")
-
-        # Close database session
-        self.session.close()
+        if cache_ttl:
+            # Changes made while the response is built make it out of date
+            with self.timer.phase('generations'):
+                cache_tables = self._response_tables()
+                cache_generations = _global_data.response_cache.generations(cache_tables)
+
+        with self.timer.phase('handler'):
+            result = procedure(*args, **kwargs)
+        with self.timer.phase('etag'):
+            not_modified = self._not_modified(result)
+        if not_modified:
+            retval = ''
+        else:
+            with self.timer.phase('render'):
+                retval = self._render(result)
+            if (cache_ttl and self.errno is None and isinstance(retval, basestring) and
+                    unicode(self.status).startswith('200') and web.ctx.status.startswith('200')):
+                _global_data.response_cache.put(self._response_cache_key(), retval, web.ctx.headers[header_count:],
+                                                cache_tables, cache_generations, cache_ttl)
+        with self.timer.phase('log'):
+            self.log("Accessed page")
         return retval
 
     # Pseudo-procedures for base class page.  These should be overridden by any
@@ -549,8 +926,85 @@ class Page:
     def DELETE(self, *args, **kwargs):
         return self._set_status(self.delete, args, kwargs)
 
+_primary_key_attributes = {}
+
+def _get_primary_key_attributes(table):
+    """
+    Return list of mapped attributes for table's primary key columns
+    """
+    try:
+        return _primary_key_attributes[table]
+    except KeyError:
+        pass
+    mapper = class_mapper(table)
+    attributes = [getattr(table, mapper.get_property_by_column(column).key) for column in mapper.primary_key]
+    _primary_key_attributes[table] = attributes
+    return attributes
+
+def _cursor_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+def _encode_cursor(primary_key):
+    """
+    Encode primary key values as an opaque cursor for keyset paging
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(primary_key), default=_cursor_default))
+
+def _cursor_value(value, attribute):
+    """
+    Return cursor value converted to the type of primary key attribute, or
+    raise ValueError if it isn't a value of that type
+    """
+    try:
+        python_type = attribute.property.columns[0].type.python_type
+    except NotImplementedError:
+        raise ValueError('Unsupported primary key type')
+    if python_type in (int, long):
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            return value
+    elif issubclass(python_type, basestring):
+        if isinstance(value, basestring):
+            return value
+    elif python_type is datetime.datetime:
+        if isinstance(value, basestring):
+            for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+                try:
+                    return datetime.datetime.strptime(value, fmt)
+                except ValueError:
+                    pass
+    elif python_type is datetime.date:
+        if isinstance(value, basestring):
+            return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    raise ValueError('Invalid cursor value %r' % (value,))
+
+def _decode_cursor(cursor, primary_keys):
+    """
+    Return list of primary key values from cursor, or None if cursor isn't
+    valid for primary_keys
+    """
+    try:
+        primary_key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if not isinstance(primary_key, list) or len(primary_key) != len(primary_keys):
+        return None
+    try:
+        return [_cursor_value(value, attribute) for (value, attribute) in zip(primary_key, primary_keys)]
+    except ValueError:
+        return None
+
 class ListPage(Page):
     permissions = 'show_list'
+    # If None, use the table's Keyset setting to decide whether to page by
+    # primary key (see ListPage._get_keyset_query)
+    keyset = None
+    # Lists longer than this are streamed to the client while being read from
+    # the database rather than being built in memory first.  Streamed lists
+    # are read stream_batch rows at a time
+    stream_limit = 1000
+    stream_batch = 500
     table = Page.table
     priority = Page.priority
     user = Page.user
@@ -578,15 +1032,17 @@ class ListPage(Page):
             self.error = u"Table class %s doesn't have Link attribute" % (self.table.__class__.__name__)
             return
 
-        datalist = []
-
-        user_data = web.input(offset=self.offset, limit=self.limit)
+        user_data = web.input(offset=self.offset, limit=self.limit, after=None)
         try:
             user_data.limit = int(user_data.limit)
         except:
             self.errno = INVALID
             self.error = u"Unable to set limit %s for table %s" % (user_data.limit, self.table.Link)
             return
+        if user_data.limit < 1:
+            self.errno = INVALID
+            self.error = u"Limit %i for table %s must be at least 1" % (user_data.limit, self.table.Link)
+            return
         try:
             user_data.offset = int(user_data.offset)
         except:
@@ -597,21 +1053,134 @@ class ListPage(Page):
 #        if self.query is None:
 #            self.errno =
 
-        items = self.query.limit(user_data.limit).offset(user_data.offset)
-        print items.statement
-
-        for item in items:
-            (index, value) = item.get_primary_key()
-            datalist.append({index: value, u'link': self.gen_link(self.prefix + '/' + item.get_obj_link())})
+        keyset = self.keyset
+        if keyset is None:
+            keyset = self.table.Keyset
+        next_cursor = None
+        stream = self.stream_limit is not None and user_data.limit > self.stream_limit
+
+        # Only the primary key is needed to list items, so don't load whole
+        # objects
+        primary_keys = _get_primary_key_attributes(self.table)
+        query = self.query.with_entities(*primary_keys)
+
+        if keyset or user_data.after is not None:
+            if user_data.after is not None and user_data.offset != 0:
+                self.errno = INVALID
+                self.error = u"Offset and after can't be used together"
+                return
+            query = self._get_keyset_query(query, primary_keys, user_data)
+            if query is None:
+                return
+            if stream:
+                # The next page link has to be known before the rows are sent,
+                # so look up the last row on this page and the one after it
+                last = query.offset(user_data.offset + user_data.limit - 1).limit(2).all()
+                if len(last) > 1:
+                    next_cursor = last[0]
+                items = query.offset(user_data.offset).limit(user_data.limit)
+            else:
+                items = query.offset(user_data.offset).limit(user_data.limit + 1).all()
+                if len(items) > user_data.limit:
+                    items = items[:user_data.limit]
+                    next_cursor = items[-1]
+        else:
+            items = query.limit(user_data.limit).offset(user_data.offset)
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug("%s", items.statement)
+        if stream:
+            items = items.yield_per(self.stream_batch)
+
+        index = unicode(class_mapper(self.table).primary_key[0].key)
+        link_base = self.gen_link(self.prefix + '/')
+        get_link = self.table.get_obj_link_from_key
+
+        def rows():
+            for item in items:
+                yield {index: item[0], u'link': link_base + get_link(item[0])}
+
+        if stream:
+            self._streaming = True
+            datalist = StreamList(rows(), self._close_session)
+            web.ctx.environ[_STREAM_CLOSE_KEY] = datalist.close
+        else:
+            datalist = list(rows())
 
+        if next_cursor is not None:
+            next_link = self._gen_next_link(_encode_cursor(next_cursor))
+            web.header('Link', '<%s>; rel="next"' % (next_link,))
+            return {u'list': datalist, u'next': next_link}
         return {u'list': datalist}
 
+    def _get_keyset_query(self, query, primary_keys, user_data):
+        """
+        Return query ordered by primary key, starting after the primary key in
+        user_data.after if it is set
+        """
+        query = query.order_by(*primary_keys)
+
+        if user_data.after is not None:
+            after = _decode_cursor(user_data.after, primary_keys)
+            if after is None:
+                self.errno = INVALID
+                self.error = u"Invalid cursor %s for table %s" % (user_data.after, self.table.Link)
+                return None
+            if len(primary_keys) == 1:
+                query = query.filter(primary_keys[0] > after[0])
+            else:
+                query = query.filter(tuple_(*primary_keys) > tuple_(*after))
+
+        return query
+
+    def _gen_next_link(self, cursor):
+        """
+        Generate link to the next page, keeping all query arguments except
+        offset
+        """
+        args = []
+        for key, value in web.input().items():
+            if key in ('after', 'offset'):
+                continue
+            args.append((key.encode('utf-8'), unicode(value).encode('utf-8')))
+        args.append(('after', cursor))
+        return u"%s?%s" % (self.gen_link(web.ctx.path), urllib.urlencode(args))
+
     def _get(self):
         return self.get_list()
 
     def get(self):
         return self._get()
 
+_link_relationships = {}
+
+def _get_link_relationships(table):
+    """
+    Return list of (name, remote column, link) for every many-to-one
+    relationship from table to a table with a Link.  These are the tables an
+    object page can link to.  The list is only worked out once per table.
+    """
+    try:
+        return _link_relationships[table]
+    except KeyError:
+        pass
+
+    relationships = []
+    for r in class_mapper(table).iterate_properties:
+        if not isinstance(r, sqlalchemy.orm.properties.RelationshipProperty): # @UndefinedVariable
+            continue
+        if r.direction.name != "MANYTOONE" or not hasattr(r.mapper.class_, "Link"):
+            continue
+
+        # Deal with sqlachemy changes
+        if hasattr(r, 'local_remote_pairs'): # sqlachemy 0.9+
+            remote = r.local_remote_pairs[0][1]
+        else:                                # sqlalchemy < 0.9
+            remote = r.remote_side[0]
+        relationships.append((unicode(r.key), remote, r.mapper.class_.Link))
+
+    _link_relationships[table] = relationships
+    return relationships
+
 class ObjectPage(Page):
     permissions = 'show_object'
     table = Page.table
@@ -643,36 +1212,33 @@ class ObjectPage(Page):
 
         datalist = [{u'name': u'Attributes', u'link': self.gen_link(self.base_link + '/' + index + '/attributes')}]
 
-        query = self.session.query(self.table).get(index)
+        # Check whether the object exists and which linked tables have rows
+        # pointing to it in one query
+        relationships = _get_link_relationships(self.table)
+        primary_key = class_mapper(self.table).primary_key[0]
+        query = self.session.query(primary_key).filter(primary_key == index)
+        query = query.add_columns(*[exists().where(remote == index) for (_key, remote, _link) in relationships])
+        row = query.first()
 
-        if query is None:
+        if row is None:
             self.errno = NOT_FOUND
             self.error = u"Unable to find primary key '%s' for table %s" % (index, self.table.Link)
             return
 
-        for r in object_mapper(query).iterate_properties:
-            if not isinstance(r, sqlalchemy.orm.properties.RelationshipProperty): # @UndefinedVariable
+        for (key, _remote, link), has_rows in zip(relationships, row[1:]):
+            if not has_rows:
                 continue
-
-            if r.direction.name == "MANYTOONE":
-                if not hasattr(r.argument.class_, "Link"):
-                    continue
-
-                remote = None
-                # Deal with sqlachemy changes
-                if hasattr(r, 'local_remote_pairs'): # sqlachemy 0.9+
-                    remote = r.local_remote_pairs[0][1]
-                else:                                # sqlalchemy < 0.9
-                    remote = r.remote_side[0]
-                test = self.session.query(remote.table).filter(remote == index).first()
-                if test is None:
-                    continue
-
-                link = r.argument.class_.Link
-                datalist.append({u'name': unicode(r.key), u'link': self.gen_link(self.base_link + '/' + index + '/' + link)})
+            datalist.append({u'name': key, u'link': self.gen_link(self.base_link + '/' + index + '/' + link)})
 
         return {u'links': datalist}
 
+    def _response_tables(self):
+        # Links are only listed for tables with rows pointing to the object
+        tables = Page._response_tables(self)
+        for (_key, remote, _link) in _get_link_relationships(self.table):
+            tables.add(remote.table.name)
+        return tables
+
     def _get(self, index):
         return self.get_links(index)
 
@@ -720,9 +1286,8 @@ class AttrPage(Page):
 
         for r in query.__mapper__.iterate_properties:
             key = getattr(query, r.key)
-            print r
             is_relationship = isinstance(r, sqlalchemy.orm.properties.RelationshipProperty) # @UndefinedVariable
-            print is_relationship
+            _logger.debug("%s relationship: %s", r, is_relationship)
             if is_relationship:
                 if key is None or _is_listish(key):
                     continue
@@ -762,22 +1327,30 @@ class Redirect(Page):
     def GET(self, path):
         web.seeother('/' + path)
 
-def __version_check(module):
+def __version_check():
     """
     Check whether all module versions match versions in database.  If they
-    don't, only show error page
+    don't, only show error page.  Databases are only upgraded by
+    scripts/upgrade.py, never here.  Once the versions have been seen to
+    match, the version stamp is written so that processes started later
+    don't need to query the database.
     """
-    for version_class in module.__subclasses__():  # @UndefinedVariable
-        if len(version_class.__subclasses__()) > 0:
-            if not __version_check(version_class):
-                return False
-        else:
-            (good_version, error) = version_class(_global_data.db, _global_data.script_dir).check_version()
-            if not good_version:
-                globals()['ServerErrorOn'] = type('ServerErrorOn', (ServerError,), {'error_msg': error})
-                urls.append('/(.*)')
-                urls.append('ServerErrorOn')
-                return False
+    stamp = _global_data.version_stamp
+    if stamp and version.stamp_matches(stamp, _global_data.engine):
+        return True
+
+    (good_version, error) = version.check_versions(_global_data.db, _global_data.script_dir)
+    if not good_version:
+        globals()['ServerErrorOn'] = type('ServerErrorOn', (ServerError,), {'error_msg': error})
+        urls.append('/(.*)')
+        urls.append('ServerErrorOn')
+        return False
+
+    if stamp:
+        try:
+            version.write_stamp(stamp, _global_data.engine)
+        except (IOError, OSError), e:
+            _logger.warning(u"Unable to write version stamp '%s': %s", stamp, e)
     return True
 
 def __fill_uuid(klass):
@@ -794,15 +1367,52 @@ def __fill_uuid(klass):
     if isinstance(klass.uuid, str):
         raise ValueError('UUID for %s.%s is not a unicode string' % (klass.__module__, klass.__name__))
 
+_relationship_graph = {}
+
+def __build_relationship_graph():
+    """
+    Work out which columns can be used to join each pair of tables in
+    filters.  _relationship_graph maps (table, link table, key) to a tuple of
+    (link table column key, table primary key column key) pairs, one for each
+    relationship in the link table whose remote side is the table's primary
+    key.  key is the link table column named in the filter, or None for every
+    possible relationship.
+    """
+    tables = model.TableTop.__subclasses__()  # @UndefinedVariable
+    graph = {}
+    for link_table_class in tables:
+        for x in class_mapper(link_table_class).iterate_properties:
+            if not isinstance(x, sqlalchemy.orm.properties.RelationshipProperty): # @UndefinedVariable
+                continue
+            # Deal with sqlachemy changes
+            if hasattr(x, 'local_remote_pairs'): # sqlachemy 0.9+
+                local = x.local_remote_pairs[0][0]
+                remote = x.local_remote_pairs[0][1]
+            else:                                # sqlalchemy < 0.9
+                remote = x.remote_side[0]
+                local = x.local_side[0]
+            for table_class in tables:
+                if remote is not class_mapper(table_class).primary_key[0]:
+                    continue
+                join_columns = (unicode(local.key), unicode(remote.key))
+                graph.setdefault((table_class, link_table_class, None), []).append(join_columns)
+                graph.setdefault((table_class, link_table_class, join_columns[0]), []).append(join_columns)
+
+    _relationship_graph.clear()
+    for key, value in graph.items():
+        _relationship_graph[key] = tuple(value)
+
 def __generate_auto_db():
     """
     Automatically create pages from database entries
     """
+    __build_relationship_graph()
+
     for x in model.TableTop.__subclasses__():  # @UndefinedVariable
         if hasattr(x, 'Link'):
-            globals()['Auto%sListPage' % (x.__name__,)] = type('Auto%sListPage' % (x.__name__,), (ListPage,), {'table': x, 'priority': 90, 'url': '/%s' % (x.Link,), 'base_link': x.Link, 'uuid': x.uuid})
-            globals()['Auto%sObjectPage' % (x.__name__,)] = type('Auto%sObjectPage' % (x.__name__,), (ObjectPage,), {'table': x, 'priority': 90, 'url': '/%s/([^/]*)' % (x.Link,), 'base_link': x.Link, 'uuid': x.uuid})
-            globals()['Auto%sAttrPage' % (x.__name__,)] = type('Auto%sAttrPage' % (x.__name__,), (AttrPage,), {'table': x, 'priority': 90, 'url': '/%s/([^/]*)/attributes' % (x.Link,), 'base_link': x.Link, 'uuid': x.uuid})
+            globals()['Auto%sListPage' % (x.__name__,)] = type('Auto%sListPage' % (x.__name__,), (ListPage,), {'table': x, 'priority': 90, 'url': '/%s' % (x.Link,), 'base_link': x.Link, 'uuid': x.uuid, 'cache_response': True})
+            globals()['Auto%sObjectPage' % (x.__name__,)] = type('Auto%sObjectPage' % (x.__name__,), (ObjectPage,), {'table': x, 'priority': 90, 'url': '/%s/([^/]*)' % (x.Link,), 'base_link': x.Link, 'uuid': x.uuid, 'cache_response': True})
+            globals()['Auto%sAttrPage' % (x.__name__,)] = type('Auto%sAttrPage' % (x.__name__,), (AttrPage,), {'table': x, 'priority': 90, 'url': '/%s/([^/]*)/attributes' % (x.Link,), 'base_link': x.Link, 'uuid': x.uuid, 'cache_response': True})
 
 def __urls_from_url_dict():
     del urls[:]
@@ -815,28 +1425,87 @@ def __urls_from_url_dict():
             # urls.append('/?(.*)' + path)
     templist.sort()
     for (order, path, klass) in templist:
-        print order, path, klass
+        _logger.debug("%s %s %s", order, path, klass)
         klasslist = klass.split('.')
         klass_basename = klasslist[-1]
         klass_module = ".".join(klasslist[:-1])
-        test = getattr(__import__(klass_module, globals(), locals(), klass_basename), klass_basename)
-
-        __fill_uuid(test)
+        # Views from the route manifest are left for web.py to import the
+        # first time they're used
+        if klass_module in sys.modules:
+            __fill_uuid(getattr(sys.modules[klass_module], klass_basename))
         urls.append(path)
         urls.append(klass)
     return
 
-__import__('view')
+def __defines_tables(module):
+    for value in vars(module).values():
+        if (isinstance(value, type) and value.__module__ == module.__name__ and
+                issubclass(value, model.TableTop)):
+            return True
+    return False
 
-if __version_check(VersionCheck):
+def __load_views():
+    """
+    Fill in url_dict from the route manifest, only importing the views that
+    define database tables.  If there's no manifest, or the view files have
+    changed since it was written, import every view and write a new one.
+    """
+    path = _global_data.route_manifest
+    view_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'view')
+    if path:
+        files = manifest.view_files(view_dir)
+        routes = manifest.load(path, files)
+        if routes is not None:
+            for module in routes[u'eager']:
+                __import__(str(module))
+            for (pattern, priority, target, absolute) in routes[u'routes']:
+                (module, name) = str(target).rsplit('.', 1)
+                _append_url(pattern, priority, module, name, absolute)
+            return
+
+    loaded = set(sys.modules)
     recursive_import(os.path.join(os.path.dirname(__file__), os.path.join('view', '__init__.py')))
+    modules = [name for name in set(sys.modules) - loaded
+               if name.startswith('view.') and sys.modules[name] is not None]
+    if not path:
+        return
+    # Check every view has a uuid before writing it down
+    for (priority, target, absolute) in url_dict.values():  # @UnusedVariable
+        (module, name) = target.rsplit('.', 1)
+        if module in modules:
+            __fill_uuid(getattr(sys.modules[module], name))
+    eager = [name for name in modules if __defines_tables(sys.modules[name])]
+    try:
+        manifest.write(path, manifest.build(url_dict, modules, eager, files))
+    except (IOError, OSError), e:
+        _logger.warning(u"Unable to write route manifest '%s': %s", path, e)
+    else:
+        _logger.info(u"Wrote route manifest '%s'", path)
 
+def __load_config():
+    """
+    Load every configuration value in one query rather than one query per
+    value on the first requests
+    """
+    session = _global_data.db.create_session()
+    try:
+        config.load_config(session)
+    finally:
+        session.close()
+
+__import__('view')
+
+def __fill_table_uuids():
     for x in model.TableTop.__subclasses__():  # @UndefinedVariable
         __fill_uuid(x)
 
-    __generate_auto_db()
-
-    __urls_from_url_dict()
+if _startup_phase('version check', __version_check):
+    _startup_phase('load config', __load_config)
+    _startup_phase('views', __load_views)
+    _startup_phase('table uuids', __fill_table_uuids)
+    _startup_phase('auto pages', __generate_auto_db)
+    _startup_phase('urls', __urls_from_url_dict)
 
-if DEBUG:
-    print urls
+_logger.info("Started in %.1fms (%s)", sum(seconds for (_phase, seconds) in startup_times) * 1000,
+             ', '.join('%s %.1fms' % (phase, seconds * 1000) for (phase, seconds) in startup_times))
+_logger.debug("%s", urls)
@@ -23,10 +23,43 @@ except ImportError:
     import json
 
 from urlparse import urlparse
+from cStringIO import StringIO
 
+import csv
 import xmlrpclib
 import datetime
 
+# Number of streamed rows to join into each chunk that's sent
+STREAM_CHUNK_ROWS = 100
+
+class StreamList(object):
+    """
+    List whose items are only produced while the response is being sent, so
+    the whole list never has to be held in memory.  It can only be iterated
+    once.  on_close is called once, when iteration stops or the list is
+    closed, whichever comes first.
+    """
+
+    def __init__(self, iterable, on_close=None):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        try:
+            for item in self.iterable:
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        if self.on_close is not None:
+            on_close = self.on_close
+            self.on_close = None
+            on_close()
+
+def has_stream(obj):
+    return hasattr(obj, "values") and any(isinstance(value, StreamList) for value in obj.values())
+
 def is_listish(obj):
     return ((hasattr(obj, "__getitem__") and
                not hasattr(obj, "strip")) or
@@ -41,63 +74,134 @@ def urlize(string):
         return string
     return u"<a href='%s'>%s</a>" % (string, string)
 
-def get_header(line, header_sep, row_sep, quote_str, create_links):
-    retval = ""
-    if hasattr(line, 'keys'):
-        retval = header_sep[0]
-        for key in line.keys():
-            if create_links:
-                key = urlize(key)
-            if quote_str != "" and (isinstance(key, str) or isinstance(key, unicode)):
-                key = quote_str + key.replace(quote_str, "\\" + quote_str) + quote_str
-            retval += unicode(key) + header_sep[1]
-        retval = retval[:-len(header_sep[1])] + header_sep[2]
-        retval += row_sep[1] + row_sep[0]
-    return retval
-
-def get_item(line, item_sep, quote_str, create_links):
-    if hasattr(line, "values"):
-        line = line.values()
-    retval = item_sep[0]
-    for item in line:
-        if create_links:
-            item = urlize(item)
-        if quote_str != "" and (isinstance(item, str) or isinstance(item, unicode)):
-            item = quote_str + item.replace(quote_str, "\\" + quote_str) + quote_str
-        retval += unicode(item) + item_sep[1]
-    retval = retval[:-len(item_sep[1])] + item_sep[2]
-    return retval
-
-def tablize(obj, body_start=u"", body_end=u"", row_sep=(u"", u"\n"),
-            header_sep=(u"", u",", u""), item_sep=(u"", u",", u""),
-            quote_str=u"", create_links=False):
-        retval = body_start
-        firstline = True
-        if hasattr(obj, "values"):
-            check_list = obj.values()
+# Headers already worked out, keyed on the row's keys and the table format.
+# Cleared when it gets too big, as the set of keys should be small
+_header_cache = {}
+_HEADER_CACHE_SIZE = 256
+
+class _Unquoted(object):
+    """
+    Cell the csv module writes as text without quotes.  QUOTE_NONNUMERIC
+    only leaves numbers unquoted, so this looks like one.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+    def __float__(self):
+        raise TypeError("Not a number")
+
+    def __str__(self):
+        return self.text
+
+class _CsvQuoter(object):
+    """
+    Quotes rows of cells using the csv module.  Strings are always quoted.
+    Anything else, such as numbers, dates and None, is written unquoted as
+    in TXT output, so None can be told apart from an empty string.
+    """
+
+    def __init__(self, delimiter):
+        self.buffer = StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=delimiter.encode('utf-8'),
+                                 quoting=csv.QUOTE_NONNUMERIC, lineterminator='')
+
+    def __call__(self, cells):
+        # Python 2's csv module only handles byte strings
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        row = []
+        for cell in cells:
+            if isinstance(cell, unicode):
+                cell = cell.encode('utf-8')
+            elif not isinstance(cell, (str, int, long, float)):
+                cell = _Unquoted(unicode(cell).encode('utf-8'))
+            row.append(cell)
+        self.writer.writerow(row)
+        return self.buffer.getvalue().decode('utf-8')
+
+def _format_cells(cells, sep, quoter, create_links):
+    if create_links:
+        cells = [urlize(cell) for cell in cells]
+    if quoter is not None:
+        return sep[0] + quoter(cells) + sep[2]
+    return sep[0] + sep[1].join([unicode(cell) for cell in cells]) + sep[2]
+
+def get_header(keys, header_sep, quoter, create_links):
+    cache_key = (keys, header_sep, quoter is not None, create_links)
+    header = _header_cache.get(cache_key)
+    if header is None:
+        header = _format_cells(keys, header_sep, quoter, create_links)
+        if len(_header_cache) >= _HEADER_CACHE_SIZE:
+            _header_cache.clear()
+        _header_cache[cache_key] = header
+    return header
+
+def get_item(line, keys, item_sep, quoter, create_links):
+    if keys is not None:
+        # Rows with the header's keys follow its order, and any others are
+        # written with their own values
+        if len(line) == len(keys) and all(key in line for key in keys):
+            line = [line[key] for key in keys]
         else:
-            check_list = obj
-        if len(check_list) == 1 and is_listish(check_list[0]):
-            check_list = check_list[0]
-            obj = check_list
-            if hasattr(check_list, "values"):
-                check_list = check_list.values()
-        if len(check_list) >= 1:
-            if is_listish(check_list[0]):
-                for line in obj:
-                    retval += row_sep[0]
-                    if firstline:
-                        retval += get_header(line, header_sep, row_sep, quote_str, create_links)
-                        firstline = False
-                    retval += get_item(line, item_sep, quote_str, create_links)
-                    retval += row_sep[1]
-            else:
-                retval += row_sep[0]
-                retval += get_header(obj, header_sep, row_sep, quote_str, create_links)
-                retval += get_item(obj, item_sep, quote_str, create_links)
-                retval += row_sep[1]
-        retval += body_end
-        return retval
+            line = line.values()
+    return _format_cells(line, item_sep, quoter, create_links)
+
+def get_lines(obj):
+    """
+    Return the rows of the table for obj.  If obj has a single value that's
+    a list, its items are the rows, otherwise obj is the only row.
+    """
+    if hasattr(obj, "values"):
+        check_list = obj.values()
+    else:
+        check_list = obj
+    if len(check_list) == 1 and isinstance(check_list[0], StreamList):
+        return check_list[0]
+    if len(check_list) == 1 and is_listish(check_list[0]):
+        check_list = check_list[0]
+        obj = check_list
+        if hasattr(check_list, "values"):
+            check_list = check_list.values()
+    if len(check_list) == 0:
+        return []
+    if is_listish(check_list[0]):
+        return obj
+    return [obj]
+
+def itablize(obj, body_start=u"", body_end=u"", row_sep=(u"", u"\n"),
+             header_sep=(u"", u",", u""), item_sep=(u"", u",", u""),
+             quote_csv=False, create_links=False):
+    """
+    Yield obj as a table in chunks of up to STREAM_CHUNK_ROWS rows.  Rows
+    that are dictionaries get a header with their keys, taken from the first
+    row.  If quote_csv is set, cells are quoted as CSV, separated by
+    item_sep[1].
+    """
+    quoter = None
+    if quote_csv:
+        quoter = _CsvQuoter(item_sep[1])
+    chunk = [body_start]
+    keys = None
+    firstline = True
+    for line in get_lines(obj):
+        if firstline:
+            if hasattr(line, "keys"):
+                keys = tuple(line.keys())
+                chunk.append(row_sep[0] + get_header(keys, header_sep, quoter, create_links) + row_sep[1])
+            firstline = False
+        chunk.append(row_sep[0] + get_item(line, keys, item_sep, quoter, create_links) + row_sep[1])
+        if len(chunk) >= STREAM_CHUNK_ROWS:
+            yield u"".join(chunk)
+            chunk = []
+    chunk.append(body_end)
+    yield u"".join(chunk)
+
+def tablize(obj, *args, **kwargs):
+    """
+    Return obj as a table.  Takes the same arguments as itablize.
+    """
+    return u"".join(itablize(obj, *args, **kwargs))
 
 class RenderCom:
     def __init__(self):
@@ -118,10 +222,8 @@ class RenderCom:
                 key = count
                 count += 1
             if is_listish(item):
-                print key
                 self.__xml_fix_date(item)
             else:
-                print key, item
                 if not isinstance(item, datetime.datetime) and isinstance(item, datetime.date):
                     obj[key] = datetime.datetime(item.year, item.month, item.day)
 
@@ -132,22 +234,75 @@ class RenderCom:
             raise TypeError, 'Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj))
 
     def render_xml(self, **args):
+        # xmlrpclib can't write a response in pieces, so streamed lists are
+        # read in full
+        for key, value in args.items():
+            if isinstance(value, StreamList):
+                args[key] = list(value)
         self.__xml_fix_date(args)
         return xmlrpclib.dumps((args,), methodresponse=True, allow_none=True)
 
     def render_json(self, **args):
+        if has_stream(args):
+            return self.__iter_json(args)
         return json.dumps(args, default=self.json_handler, sort_keys=True)
 
+    def __iter_json(self, args):
+        """
+        Yield the same JSON as render_json in chunks, writing streamed lists
+        STREAM_CHUNK_ROWS items at a time
+        """
+        yield u"{"
+        for count, key in enumerate(sorted(args.keys())):
+            chunk = []
+            if count > 0:
+                chunk.append(u", ")
+            chunk.append(json.dumps(key) + u": ")
+            value = args[key]
+            if not isinstance(value, StreamList):
+                chunk.append(json.dumps(value, default=self.json_handler, sort_keys=True))
+                yield u"".join(chunk)
+                continue
+            chunk.append(u"[")
+            for item_count, item in enumerate(value):
+                if item_count > 0:
+                    chunk.append(u", ")
+                chunk.append(json.dumps(item, default=self.json_handler, sort_keys=True))
+                if len(chunk) >= STREAM_CHUNK_ROWS * 2:
+                    yield u"".join(chunk)
+                    chunk = []
+            chunk.append(u"]")
+            yield u"".join(chunk)
+        yield u"}"
+
+    def __tabular(self, args):
+        """
+        A list's next page link doesn't fit in a table, so tabular formats
+        only get it in the Link header
+        """
+        if u'next' in args and u'list' in args:
+            args = dict(args)
+            del args[u'next']
+        return args
+
+    def __tablize(self, args, *format_args, **format_kwargs):
+        if has_stream(args):
+            return itablize(args, *format_args, **format_kwargs)
+        return tablize(args, *format_args, **format_kwargs)
+
     def render_html(self, **args):
-        return tablize(args, u"<html><body><table>", u"</table></body></html>",
+        args = self.__tabular(args)
+        return self.__tablize(args, u"<html><body><table>", u"</table></body></html>",
                        ("<tr>", "</tr>\n"), ("<th>", "</th><th>", "</th>"),
                                             ("<td>", "</td><td>", "</td>"),
                         create_links=True)
 
     def render_txt(self, **args):
-        return tablize(args, u"", u"", ("", "\n"), ("", "\t", ""),
+        args = self.__tabular(args)
+        return self.__tablize(args, u"", u"", ("", "\n"), ("", "\t", ""),
                                                     ("", "\t", ""))
 
     def render_csv(self, **args):
-        return tablize(args, u"", u"", ("", "\n"), ("", ",", ""),
-                                                    ("", ",", ""), "\"")
+        args = self.__tabular(args)
+        return self.__tablize(args, u"", u"", ("", "\n"), ("", ",", ""),
+                                                    ("", ",", ""), True)
@@ -0,0 +1,199 @@
+"""
+router
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+import re, threading, time
+
+import web
+
+# Prefix added to every non-absolute url (see render.__urls_from_url_dict)
+PREFIX = '/?(.*)'
+# Pattern for a url segment that's passed to the page
+PARAM = '([^/]*)'
+
+# Buckets for the match time histogram, in seconds
+MATCH_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005)
+
+_literal = re.compile(r'^[\w\-~@]*$')
+
+class _Node(object):
+    """
+    Trie node for one url segment.  Urls are stored by their segments from
+    last to first, so matching starts at the end of the path.
+    """
+    __slots__ = ('children', 'param', 'urls')
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        # List of (order, target, prefixed) for urls ending at this node
+        self.urls = []
+
+def _split_pattern(pattern):
+    """
+    Return (prefixed, segments) for pattern, or None if pattern is more
+    complicated than literal segments and parameters
+    """
+    prefixed = pattern.startswith(PREFIX)
+    if prefixed:
+        pattern = pattern[len(PREFIX):]
+    if not pattern.startswith('/'):
+        return None
+    # PARAM has a '/' in it, so swap it out before splitting
+    segments = pattern.replace(PARAM, '\0').split('/')[1:]
+    for (count, segment) in enumerate(segments):
+        if segment == '\0':
+            segments[count] = PARAM
+        elif not _literal.match(segment):
+            return None
+    return (prefixed, segments)
+
+class Router(web.application):
+    """
+    web.application that matches urls using a trie of url segments rather
+    than trying each url's regular expression in turn.  Urls that aren't
+    made up of literal segments and parameters fall back to regular
+    expressions.  As with web.application, the first url in the mapping
+    that matches wins.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._compiled = None
+        self._lock = threading.Lock()
+        self.matches = 0
+        self.misses = 0
+        self.match_total = 0.0
+        self.match_max = 0.0
+        self.match_buckets = [0] * (len(MATCH_BUCKETS) + 1)
+        web.application.__init__(self, *args, **kwargs)
+
+    def init_mapping(self, mapping):
+        web.application.init_mapping(self, mapping)
+        # In debug mode, web.py calls this on every request
+        if self._compiled is not None and self._compiled == self.mapping:
+            return
+        self._compile()
+        self._compiled = list(self.mapping)
+
+    def _compile(self):
+        self._root = _Node()
+        self._fallback = []
+        for (order, (pattern, target)) in enumerate(self.mapping):
+            split = None
+            if isinstance(target, basestring) and '\\' not in target:
+                split = _split_pattern(pattern)
+            if split is None:
+                self._fallback.append((order, pattern, target))
+                continue
+
+            (prefixed, segments) = split
+            node = self._root
+            for segment in reversed(segments):
+                if segment == PARAM:
+                    if node.param is None:
+                        node.param = _Node()
+                    node = node.param
+                else:
+                    node = node.children.setdefault(segment, _Node())
+            node.urls.append((order, target, prefixed))
+
+    def _search(self, node, segments, position, params, best):
+        """
+        Find the first url in the trie matching segments[:position + 1],
+        returning (order, target, args) or best if nothing better is found
+        """
+        for (order, target, prefixed) in node.urls:
+            if best is not None and order > best[0]:
+                continue
+            args = list(reversed(params))
+            if prefixed:
+                # Mimic '/?(.*)': everything before the matched segments,
+                # less one leading '/'
+                prefix = '/'.join(segments[:position + 1])
+                if prefix.startswith('/'):
+                    prefix = prefix[1:]
+                args.insert(0, prefix)
+            elif position != 0:
+                # segments[0] is the empty string before the path's first
+                # '/', so absolute urls must have used up everything else
+                continue
+            best = (order, target, args)
+
+        if position == 0:
+            return best
+        segment = segments[position]
+        child = node.children.get(segment)
+        if child is not None:
+            best = self._search(child, segments, position - 1, params, best)
+        if node.param is not None:
+            params.append(segment)
+            best = self._search(node.param, segments, position - 1, params, best)
+            params.pop()
+        return best
+
+    def _match(self, mapping, value):
+        if mapping is not self.mapping:
+            return web.application._match(self, mapping, value)
+
+        start = time.time()
+        best = self._search(self._root, value.split('/'), value.count('/'), [], None)
+        for (order, pattern, target) in self._fallback:
+            if best is not None and best[0] < order:
+                break
+            (target, args) = web.application._match(self, [(pattern, target)], value)
+            if target is not None:
+                best = (order, target, args)
+                break
+        self._record(time.time() - start, best is not None)
+
+        if best is None:
+            return None, None
+        return best[1], best[2]
+
+    def _record(self, elapsed, matched):
+        with self._lock:
+            if matched:
+                self.matches += 1
+            else:
+                self.misses += 1
+            self.match_total += elapsed
+            if elapsed > self.match_max:
+                self.match_max = elapsed
+            for (count, bucket) in enumerate(MATCH_BUCKETS):
+                if elapsed <= bucket:
+                    self.match_buckets[count] += 1
+                    break
+            else:
+                self.match_buckets[-1] += 1
+
+    def stats(self):
+        """
+        Return dictionary of url matching counters.  The histogram is a list
+        of (upper bound in seconds, cumulative count), the last bound being
+        None for infinity.
+        """
+        with self._lock:
+            histogram = []
+            total = 0
+            for (count, bucket) in enumerate(MATCH_BUCKETS + (None,)):
+                total += self.match_buckets[count]
+                histogram.append((bucket, total))
+            return {u'urls': len(self.mapping), u'fallback_urls': len(self._fallback),
+                    u'matches': self.matches, u'misses': self.misses,
+                    u'match_total': self.match_total, u'match_max': self.match_max,
+                    u'histogram': histogram}
@@ -17,9 +17,16 @@ Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 Copyright (C) 2012, 2015 Jonathan Dieter <jdieter@lesbg.com>
 """
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 from model.core import Version
-import subprocess, os.path
-import sys, traceback
+from controller.logger import get_logger
+import subprocess, os.path, hashlib, tempfile
+
+_logger = get_logger(__name__)
 
 class VersionCheck(object):
     """
@@ -38,8 +45,8 @@ class VersionCheck(object):
     database updates, as well as turning off automatic database updates by
     setting auto_update to False
 
-    You do not need to actually run the check, as the backend will do so
-    automatically when it starts up.
+    The backend checks versions when it starts up, but never runs update
+    files itself.  They're run by scripts/upgrade.py (see check_versions()).
     """
     db = None
     uuid = None
@@ -78,7 +85,7 @@ class VersionCheck(object):
     def __check_file(self, start_ver, stop_ver):            
         ufile = os.path.join(self.script_dir,
                              "updates/%s/update_%i_%i.%s" % (self.uuid, start_ver, stop_ver, self.extension))
-        print ufile
+        _logger.debug("Checking for update file %s", ufile)
 
         # Check whether update exists for start_ver -> stop_ver
         if self.check_file(ufile):
@@ -104,13 +111,14 @@ class VersionCheck(object):
         else:
             return [None]
 
-    def check_version(self):
+    def check_version(self, upgrade=True):
         """
         Returns a tuple of (boolean, string|None) where the boolean is
         whether the versions match and the string is the error message
-        if they don't match
+        if they don't match.  If upgrade is True, update files are run to
+        bring an older database up to date.
         """
-        print "Checking..."
+        _logger.debug("Checking version of %s", self.uuid)
         if self.db is None:
             raise ValueError("Database variable 'db' isn't set")
         if self.uuid is None:
@@ -118,9 +126,13 @@ class VersionCheck(object):
         session = self.db.create_session()
         cur_ver = session.query(Version).get(self.uuid)
         session.close()
+        if cur_ver is None:
+            return (False, u"There is no version for module %s in the database" % (self.uuid,))
         if cur_ver.VersionNumber > self.version:
             return (False, u"The %s version in the database is %i, while our version is %i.  Please upgrade module %s" % (cur_ver.Type, cur_ver.VersionNumber, self.version, cur_ver.Type))
         elif cur_ver.VersionNumber < self.version:
+            if not upgrade:
+                return (False, u"The %s version in the database is %i, while our version is %i.  Please run scripts/upgrade.py to upgrade the database for %s" % (cur_ver.Type, cur_ver.VersionNumber, self.version, cur_ver.Type))
             script_files = [None]
             if self.script_dir is not None:
                 script_files = self.__check_file(cur_ver.VersionNumber, self.version)
@@ -160,8 +172,66 @@ class PyVersionCheck(VersionCheck):
                 return (False, u"Module %s didn't upgrade version in database" % (ufile,))
             return (True, None)
         except:
-            for item in traceback.format_exception(*sys.exc_info()):
-                print item
+            _logger.exception("Error loading update module %s", ufile)
             return (False, u"Error loading update module %s" % (ufile,))
         finally:
             f.close()
+
+def _version_classes(klass=VersionCheck):
+    """
+    Return every version check class below klass that has no subclasses
+    """
+    classes = []
+    for version_class in klass.__subclasses__():  # @UndefinedVariable
+        if len(version_class.__subclasses__()) > 0:
+            classes.extend(_version_classes(version_class))
+        else:
+            classes.append(version_class)
+    return classes
+
+def check_versions(db, script_dir=None, upgrade=False):
+    """
+    Check the version of every module that has been imported against the
+    database, running update files if upgrade is True.  Returns a tuple of
+    (boolean, string|None) as VersionCheck.check_version() does.
+    """
+    for version_class in _version_classes():
+        (good_version, error) = version_class(db, script_dir).check_version(upgrade)
+        if not good_version:
+            return (False, error)
+    return (True, None)
+
+def _stamp(engine):
+    # Only a hash of the database url is kept, as it may hold a password
+    return {u'database': unicode(hashlib.sha1(engine.encode('utf-8')).hexdigest()),
+            u'versions': dict((unicode(version_class.uuid), version_class.version)
+                              for version_class in _version_classes())}
+
+def stamp_matches(path, engine):
+    """
+    Return True if the version stamp at path was written for database url
+    engine with the versions of the modules that have been imported
+    """
+    try:
+        with open(path) as f:
+            stamp = json.load(f)
+    except (IOError, ValueError):
+        return False
+    return stamp == _stamp(engine)
+
+def write_stamp(path, engine):
+    """
+    Record that the database at url engine has the versions of the modules
+    that have been imported, so processes starting later don't need to
+    check the database
+    """
+    (fd, temp_path) = tempfile.mkstemp(prefix='.version', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_stamp(engine), f, sort_keys=True)
+            f.write('\n')
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
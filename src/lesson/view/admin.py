@@ -0,0 +1,90 @@
+"""
+view.admin
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+uuid = u'7bb2302a-a003-11e1-9b06-00163e9a5f9b'
+
+import web
+
+from render import Page
+
+class PoolPage(Page):
+    """
+    Database connection pool usage for this backend process
+    """
+    url = "/admin/pool"
+    url_absolute = True
+    permission = "show_pool"
+    # Statistics change on every request
+    conditional = False
+
+    def get(self):
+        stats = self.db.pool_stats.stats()
+        datalist = []
+        for name in (u'size', u'checked_out', u'overflow', u'checkouts', u'wait_total', u'wait_max'):
+            datalist.append({u'name': name, u'value': stats[name]})
+        for (bucket, count) in stats[u'histogram']:
+            if bucket is None:
+                name = u'checkout_latency_le_inf'
+            else:
+                name = u'checkout_latency_le_%s' % (bucket,)
+            datalist.append({u'name': name, u'value': count})
+        return {u'pool': datalist}
+
+class RouterPage(Page):
+    """
+    Url matching statistics for this backend process
+    """
+    url = "/admin/router"
+    url_absolute = True
+    permission = "show_router"
+    # Statistics change on every request
+    conditional = False
+
+    def get(self):
+        stats = self.router.stats()
+        datalist = []
+        for name in (u'urls', u'fallback_urls', u'matches', u'misses', u'match_total', u'match_max'):
+            datalist.append({u'name': name, u'value': stats[name]})
+        for (bucket, count) in stats[u'histogram']:
+            if bucket is None:
+                name = u'match_time_le_inf'
+            else:
+                name = u'match_time_le_%s' % (bucket,)
+            datalist.append({u'name': name, u'value': count})
+        return {u'router': datalist}
+
+class MetricsPage(Page):
+    """
+    Metrics for every backend process in Prometheus text exposition format
+    """
+    url = "/admin/metrics"
+    url_absolute = True
+    permission = "show_metrics"
+    # Statistics change on every request
+    conditional = False
+
+    def get(self):
+        return self.get_metrics()
+
+    def _render(self, *args, **kwargs):
+        # Errors are rendered as usual, but the metrics are already text
+        if self.errno is not None or len(args) != 1:
+            return Page._render(self, *args, **kwargs)
+        web.header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        return args[0]
@@ -0,0 +1,49 @@
+"""
+view.login
+
+This file is part of LESSON.  LESSON is free software: you can
+redistribute it and/or modify it under the terms of the GNU General Public
+License as published by the Free Software Foundation, version 2 or later.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+details.
+
+You should have received a copy of the GNU General Public License along with
+this program; if not, write to the Free Software Foundation, Inc., 51
+Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+Copyright (C) 2015 Jonathan Dieter <jdieter@lesbg.com>
+"""
+
+uuid = u'7bb2302a-a003-11e1-9b06-00163e9a5f9b'
+
+from render import Page
+from error import FORBIDDEN, NOT_FOUND
+
+class LoginPage(Page):
+    """
+    Exchange HTTP Basic credentials for a bearer token that can be sent as
+    'Authorization: Bearer <token>' until it expires
+    """
+    url = "/login"
+    url_absolute = True
+    # Every token is new
+    conditional = False
+
+    def get(self):
+        # Tokens may only be issued against a password, otherwise a stolen
+        # token could be renewed forever
+        if self.auth_method != u'basic':
+            self.errno = FORBIDDEN
+            self.error = u"A username and password are required to get a token"
+            return
+
+        issued = self.issue_token()
+        if issued is None:
+            self.errno = NOT_FOUND
+            self.error = u"Bearer tokens are disabled, as no token secret is set"
+            return
+        (token, expires) = issued
+        return {u'token': token, u'expires': expires}